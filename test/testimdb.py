@@ -2,7 +2,10 @@
 import os
 import sys
 import unittest
+import unittest.mock
 import tornado.gen
+import tornado.testing
+import tornado.web
 
 TEST_PATH = os.path.dirname(sys.argv[0])
 ROOT_PATH = os.path.join(TEST_PATH, '..')
@@ -91,3 +94,84 @@ class IMDBTestCase(unittest.TestCase):
         self.assertRaises(ValueError,
             tornado.ioloop.IOLoop.current().run_sync, cor)
 
+
+class _StatusHandler(tornado.web.RequestHandler):
+    '''Answer with the next status code of a list.'''
+
+    def initialize(self, codes):
+        self._codes = codes
+
+    def get(self):
+        code = self._codes.pop(0)
+        self.set_status(code)
+        if code == 200:
+            self.write(b'page')
+
+
+class FetchRetryTestCase(tornado.testing.AsyncHTTPTestCase):
+    '''Test the retries of the requests throttled by IMDB.'''
+
+    def setUp(self):
+        self.codes = []
+        super().setUp()
+        # Don't wait between attempts
+        patcher = unittest.mock.patch('tvfamily.imdb._MAX_RETRY_DELAY', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_app(self):
+        return tornado.web.Application(
+            [(r'/', _StatusHandler, {'codes': self.codes})])
+
+    @tornado.testing.gen_test
+    def test_retried_until_ok(self):
+        self.codes.extend([503, 429, 200])
+        body = yield tvfamily.imdb._fetch(self.get_url('/'))
+        self.assertEqual(body, b'page')
+        self.assertEqual(self.codes, [])
+
+    @tornado.testing.gen_test
+    def test_too_many_attempts(self):
+        self.codes.extend([503] * tvfamily.imdb._MAX_ATTEMPTS)
+        with self.assertRaises(tornado.httpclient.HTTPError) as cm:
+            yield tvfamily.imdb._fetch(self.get_url('/'))
+        self.assertEqual(cm.exception.code, 503)
+        self.assertEqual(self.codes, [])
+
+    @tornado.testing.gen_test
+    def test_other_errors_not_retried(self):
+        self.codes.extend([404, 200])
+        with self.assertRaises(tornado.httpclient.HTTPError) as cm:
+            yield tvfamily.imdb._fetch(self.get_url('/'))
+        self.assertEqual(cm.exception.code, 404)
+        self.assertEqual(self.codes, [200])
+
+
+class ParseTitleTestCase(unittest.TestCase):
+    '''Test the parsing of the og:title of the IMDB title pages.'''
+
+    def test_movie(self):
+        self.assertEqual(
+            tvfamily.imdb._parse_title('The Matrix (1999) - IMDb'),
+            ('The Matrix', None, 1999, None))
+
+    def test_series(self):
+        self.assertEqual(tvfamily.imdb._parse_title(
+            'The Expanse (TV Series 2015–2022) - IMDb'),
+            ('The Expanse', 'TV Series', 2015, 2022))
+
+    def test_series_not_ended(self):
+        self.assertEqual(tvfamily.imdb._parse_title(
+            'The Expanse (TV Series 2015– ) - IMDb'),
+            ('The Expanse', 'TV Series', 2015, 0))
+
+    def test_mini_series(self):
+        self.assertEqual(tvfamily.imdb._parse_title(
+            'Chernobyl (TV Mini-Series 2019) - IMDb'),
+            ('Chernobyl', 'TV Mini-Series', 2019, None))
+
+    def test_no_year(self):
+        self.assertEqual(tvfamily.imdb._parse_title('Some Page - IMDb'),
+            ('Some Page', None, None, None))
+        self.assertEqual(tvfamily.imdb._parse_title('Raw text'),
+            ('Raw text', None, None, None))
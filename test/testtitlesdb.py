@@ -1,8 +1,11 @@
 
 import os
+import shutil
 import sys
+import tempfile
 import time
 import unittest
+import unittest.mock
 import tornado.gen
 
 TEST_PATH = os.path.dirname(sys.argv[0])
@@ -107,3 +110,95 @@ class TitlesDBTestCase(unittest.TestCase):
         db = tvfamily.core.TitlesDB(categories, TEST_PATH)
         self.assertEqual(db.get_categories(), categories)
 
+
+class GetVideoTestCase(unittest.TestCase):
+    '''Test the lookup of the videos of the titles.'''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.videos_path = os.path.join(self.tmpdir, 'videos')
+        os.mkdir(self.videos_path)
+        data_path = os.path.join(self.tmpdir, 'data')
+        os.mkdir(data_path)
+        self._add_video('tt0000001', 'Show.S01E01.mp4')
+        self._add_video('tt0000001', 'Show.S01E02.mp4')
+        self.movie = self._add_video('tt0000002', 'Movie.2018.mp4')
+        self.db = tvfamily.core.TitlesDB([], self.videos_path, data_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _add_video(self, imdb_id, name):
+        title_path = os.path.join(self.videos_path, imdb_id)
+        os.makedirs(title_path, exist_ok=True)
+        path = os.path.join(title_path, name)
+        open(path, 'wb').close()
+        # Make sure that the change is seen, whatever the mtime resolution
+        st = os.stat(title_path)
+        os.utime(title_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        return path
+
+    def test_episode(self):
+        video = self.db.get_video('tt0000001', 1, 2)
+        self.assertEqual(video.path,
+            os.path.join(self.videos_path, 'tt0000001', 'Show.S01E02.mp4'))
+        # A second lookup gives the same path
+        video = self.db.get_video('tt0000001', 1, 2)
+        self.assertEqual(os.path.basename(video.path), 'Show.S01E02.mp4')
+
+    def test_missing_episode(self):
+        self.assertIsNone(self.db.get_video('tt0000001', 1, 3))
+
+    def test_new_episode(self):
+        self.assertIsNone(self.db.get_video('tt0000001', 1, 3))
+        path = self._add_video('tt0000001', 'Show.S01E03.mp4')
+        self.assertEqual(self.db.get_video('tt0000001', 1, 3).path, path)
+
+    def test_movie(self):
+        self.assertEqual(self.db.get_video('tt0000002').path, self.movie)
+
+    def test_unknown_title(self):
+        self.assertRaises(KeyError, self.db.get_video, 'tt0000003')
+
+
+class SearchTruncatedTestCase(unittest.TestCase):
+    '''Test the truncation of the search results.'''
+
+    MAX = tvfamily.core.TitlesDB.MAX_SEARCH_RESULTS
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        categories = [tvfamily.core.Category('Movies', ['Movie'])]
+        self.db = tvfamily.core.TitlesDB(
+            categories, self.tmpdir, self.tmpdir)
+        # Don't fetch the titles found
+        async def fetch_and_save(imdb_title, fetch_pictures=True):
+            pass
+        self.db._imdb_title_fetch_and_save = fetch_and_save
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _search(self, n):
+        '''Search in a fake IMDB that has n results.'''
+        async def search(title, title_types, year=None, limit=None):
+            return [tvfamily.imdb.IMDBTitle('tt{:07}'.format(i),
+                {'type': 'Movie'}) for i in range(n)][:limit]
+        with unittest.mock.patch('tvfamily.imdb.search', search):
+            return tornado.ioloop.IOLoop.current().run_sync(
+                lambda: self.db.search('Movies', 'movie'))
+
+    def test_truncated(self):
+        titles, truncated = self._search(self.MAX + 5)
+        self.assertEqual(len(titles), self.MAX)
+        self.assertTrue(truncated)
+
+    def test_exactly_the_maximum(self):
+        titles, truncated = self._search(self.MAX)
+        self.assertEqual(len(titles), self.MAX)
+        self.assertFalse(truncated)
+
+    def test_few_results(self):
+        titles, truncated = self._search(3)
+        self.assertEqual(len(titles), 3)
+        self.assertFalse(truncated)
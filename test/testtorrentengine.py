@@ -1,6 +1,8 @@
 
 import os
+import shutil
 import sys
+import tempfile
 import unittest
 import tornado.gen
 
@@ -9,6 +11,7 @@ ROOT_PATH = os.path.join(TEST_PATH, '..')
 
 sys.path.insert(0, ROOT_PATH)
 import tvfamily.core
+import tvfamily.torrent
 
 # Select libcurl implementation for HTTP requests
 tornado.httpclient.AsyncHTTPClient.configure(
@@ -92,3 +95,111 @@ class TorrentEngineTestCase(unittest.TestCase):
         for x, e in zip(f, expected):
             self.assertEqual(x, e)
 
+
+class ReloadPluginsTestCase(unittest.TestCase):
+    '''Test that the plugins are only reloaded when their path changes.'''
+
+    def setUp(self):
+        self.data_path = tempfile.mkdtemp()
+        self.plugins_path = os.path.join(self.data_path, 'plugins')
+        os.mkdir(self.plugins_path)
+        self._add_plugin('plugin1')
+        self.engine = tvfamily.core.TorrentEngine(
+            self.data_path, {'plugins': {'path': self.plugins_path}})
+        # Record the names of the plugins actually loaded
+        self.loaded = []
+        load_plugin = self.engine._load_plugin
+        def _load_plugin(name):
+            self.loaded.append(name)
+            return load_plugin(name)
+        self.engine._load_plugin = _load_plugin
+
+    def tearDown(self):
+        shutil.rmtree(self.data_path)
+
+    def _add_plugin(self, name):
+        with open(os.path.join(self.plugins_path, name + '.py'), 'w') as f:
+            f.write('async def top(category, options):\n    return []\n')
+        self._touch_plugins_path()
+
+    def _touch_plugins_path(self):
+        # Make sure that the change is seen, whatever the mtime resolution
+        st = os.stat(self.plugins_path)
+        os.utime(self.plugins_path,
+            ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    def _reload_plugins(self):
+        tornado.ioloop.IOLoop.current().run_sync(
+            self.engine._reload_plugins)
+
+    def test_unchanged_path(self):
+        self._reload_plugins()
+        self._reload_plugins()
+        self.assertEqual(self.loaded, ['plugin1'])
+        self.assertEqual(len(self.engine._plugins), 1)
+
+    def test_new_plugin(self):
+        self._reload_plugins()
+        self._add_plugin('plugin2')
+        self._reload_plugins()
+        self.assertEqual(sorted(self.loaded), ['plugin1', 'plugin2'])
+        self.assertEqual([p.__name__ for p in self.engine._plugins],
+            ['plugin1', 'plugin2'])
+
+    def test_removed_plugin(self):
+        self._reload_plugins()
+        os.remove(os.path.join(self.plugins_path, 'plugin1.py'))
+        self._touch_plugins_path()
+        self._reload_plugins()
+        self.assertEqual(self.engine._plugins, [])
+
+
+class FilterTestCase(unittest.TestCase):
+    '''Test the filtering of torrents by quality, codec, resolution and 3D.'''
+
+    NAMES = [
+        'Movie.2018.720p.BluRay.x264-GRP',
+        'Movie.2018.1080p.WEB-DL.H265-GRP',
+        'Movie.2018.HDTV.XviD-GRP',
+        'Movie.2018.3D.1080p.BluRay.x264-GRP',
+        'Movie.2018-GRP',
+    ]
+
+    def setUp(self):
+        options = {'plugins': {'path': os.path.join(TEST_PATH, 'plugins')}}
+        self.engine = tvfamily.core.TorrentEngine(TEST_PATH, options)
+        self.torrents = [tvfamily.torrent.Torrent(n) for n in self.NAMES]
+
+    def _filter(self, filters):
+        return [self.NAMES.index(t.name)
+            for t in self.engine._filter(self.torrents, filters)]
+
+    def test_no_filters(self):
+        self.assertEqual(self._filter(None), [0, 1, 2, 3, 4])
+        self.assertEqual(self._filter([None, None, None, None]),
+            [0, 1, 2, 3, 4])
+
+    def test_quality(self):
+        # The torrents without quality are not filtered
+        self.assertEqual(self._filter([['HDTV'], None, None, None]), [2, 4])
+
+    def test_codec(self):
+        self.assertEqual(self._filter([None, ['H.264'], None, None]),
+            [0, 3, 4])
+
+    def test_no_value_selected(self):
+        self.assertEqual(self._filter([None, None, [], None]), [])
+
+    def test_all_values_selected(self):
+        quality = list(tvfamily.core.TorrentEngine._QUALITY_VALUES)
+        self.assertEqual(self._filter([quality, None, None, None]),
+            [0, 1, 2, 3, 4])
+
+    def test_3d(self):
+        self.assertEqual(self._filter([None, None, ['1080p'], []]), [1, 2, 4])
+        self.assertEqual(self._filter([None, None, ['1080p'], ['3D']]),
+            [1, 2, 3, 4])
+
+    def test_combined(self):
+        filters = [['Blu-ray', 'WEB-DL'], ['H.264', 'H.265'], ['1080p'], None]
+        self.assertEqual(self._filter(filters), [1, 3, 4])
@@ -0,0 +1,136 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import tornado.testing
+import tornado.web
+
+TEST_PATH = os.path.dirname(sys.argv[0])
+ROOT_PATH = os.path.join(TEST_PATH, '..')
+
+sys.path.insert(0, ROOT_PATH)
+import tvfamily.webservice
+import tvfamily.core
+
+
+class ParseRangeTestCase(unittest.TestCase):
+    '''Test the parsing of the Range header.'''
+
+    def test_closed_range(self):
+        self.assertEqual(tvfamily.webservice._parse_range('bytes=0-99'),
+            (0, 100))
+        self.assertEqual(tvfamily.webservice._parse_range('bytes=5-5'),
+            (5, 6))
+
+    def test_open_ended_range(self):
+        self.assertEqual(tvfamily.webservice._parse_range('bytes=0-'),
+            (0, None))
+        self.assertEqual(tvfamily.webservice._parse_range('bytes=100-'),
+            (100, None))
+
+    def test_suffix_range(self):
+        self.assertEqual(tvfamily.webservice._parse_range('bytes=-500'),
+            (-500, None))
+
+    def test_suffix_range_zero(self):
+        # Kept as an empty range, that is not satisfiable
+        self.assertEqual(tvfamily.webservice._parse_range('bytes=-0'),
+            (None, 0))
+
+    def test_reversed_range(self):
+        self.assertIsNone(tvfamily.webservice._parse_range('bytes=10-5'))
+
+    def test_multiple_ranges(self):
+        self.assertIsNone(tvfamily.webservice._parse_range('bytes=0-1,5-6'))
+
+    def test_whitespace(self):
+        self.assertEqual(tvfamily.webservice._parse_range(' bytes = 0 - 9 '),
+            (0, 10))
+
+    def test_invalid(self):
+        self.assertIsNone(tvfamily.webservice._parse_range('bytes=-'))
+        self.assertIsNone(tvfamily.webservice._parse_range('items=0-1'))
+        self.assertIsNone(tvfamily.webservice._parse_range(''))
+
+
+class _VideoCore(object):
+    '''Core that serves always the same video.'''
+
+    def __init__(self, path):
+        self._path = path
+
+    def get_video(self, title_id, season, episode):
+        return tvfamily.core.Video(self._path)
+
+
+class GetVideoRangeTestCase(tornado.testing.AsyncHTTPTestCase):
+    '''Test the ranges served by GetVideoHandler.'''
+
+    SIZE = 1000
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'video.mp4')
+        self.data = bytes(i % 256 for i in range(self.SIZE))
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def get_app(self):
+        return tornado.web.Application([(r'/api/getvideo',
+            tvfamily.webservice.GetVideoHandler,
+            {'core': _VideoCore(self.path)})])
+
+    def _get(self, range_header=None):
+        headers = {}
+        if range_header is not None:
+            headers['Range'] = range_header
+        return self.fetch('/api/getvideo?id=tt0000001', headers=headers)
+
+    def test_no_range(self):
+        response = self._get()
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, self.data)
+
+    def test_closed_range(self):
+        response = self._get('bytes=10-19')
+        self.assertEqual(response.code, 206)
+        self.assertEqual(response.headers['Content-Range'],
+            'bytes 10-19/1000')
+        self.assertEqual(response.body, self.data[10:20])
+
+    def test_end_past_size(self):
+        response = self._get('bytes=990-2000')
+        self.assertEqual(response.code, 206)
+        self.assertEqual(response.headers['Content-Range'],
+            'bytes 990-999/1000')
+        self.assertEqual(response.body, self.data[990:])
+
+    def test_suffix_range(self):
+        response = self._get('bytes=-100')
+        self.assertEqual(response.code, 206)
+        self.assertEqual(response.headers['Content-Range'],
+            'bytes 900-999/1000')
+        self.assertEqual(response.body, self.data[900:])
+
+    def test_suffix_longer_than_size(self):
+        response = self._get('bytes=-5000')
+        self.assertEqual(response.code, 206)
+        self.assertEqual(response.headers['Content-Range'],
+            'bytes 0-999/1000')
+        self.assertEqual(response.body, self.data)
+
+    def test_start_past_size(self):
+        response = self._get('bytes=1000-')
+        self.assertEqual(response.code, 416)
+        self.assertEqual(response.headers['Content-Range'], 'bytes */1000')
+
+    def test_empty_suffix(self):
+        response = self._get('bytes=-0')
+        self.assertEqual(response.code, 416)
+        self.assertEqual(response.headers['Content-Range'], 'bytes */1000')
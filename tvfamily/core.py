@@ -20,15 +20,18 @@ along with tvfamily; see the file COPYING.  If not, see
 <http://www.gnu.org/licenses/>.
 '''
 
+import asyncio
+import collections
 import datetime
 import functools
-import glob
 import grp
 import importlib
 import io
+import itertools
 import json
 import libtorrent
 import logging
+import operator
 import os
 import PIL.Image
 import pwd
@@ -37,11 +40,22 @@ import sys
 import time
 import tornado.gen
 import tornado.ioloop
+import tornado.locks
 
 import tvfamily.imdb
 import tvfamily.PTN
 import tvfamily.torrent
 
+# Use orjson to decode the titles' databases and to encode the lists
+# served as is if it's available
+try:
+    import orjson
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:
+    _json_loads = json.loads
+    _json_dumps = json.dumps
+
 __author__ = 'Antonio Serrano Hernandez'
 __copyright__ = 'Copyright (C) 2018 2019 Antonio Serrano Hernandez'
 __version__ = '0.1'
@@ -76,9 +90,39 @@ _SETTINGS_DEFAULTS = {
 }
 
 
+# Contents of the most requested posters: path -> (mtime, data). The cache
+# is bounded by the total size of the posters, in bytes
+_POSTERS_CACHE = collections.OrderedDict()
+_POSTERS_CACHE_MAX_BYTES = 10 * 1024 * 1024
+_posters_cache_bytes = 0
+
+
 class CoreError(Exception): pass
 
 
+def _read_poster(path, mtime):
+    '''Return the contents of the poster in path. The contents are cached
+    until the poster's mtime changes, dropping the least recently used ones
+    while they exceed _POSTERS_CACHE_MAX_BYTES.
+    '''
+    global _posters_cache_bytes
+    cached = _POSTERS_CACHE.pop(path, None)
+    if cached is not None:
+        if cached[0] == mtime:
+            _POSTERS_CACHE[path] = cached
+            return cached[1]
+        _posters_cache_bytes -= len(cached[1])
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) <= _POSTERS_CACHE_MAX_BYTES:
+        _POSTERS_CACHE[path] = (mtime, data)
+        _posters_cache_bytes += len(data)
+        while _posters_cache_bytes > _POSTERS_CACHE_MAX_BYTES:
+            _, (_, dropped) = _POSTERS_CACHE.popitem(last=False)
+            _posters_cache_bytes -= len(dropped)
+    return data
+
+
 class Core(object):
     '''Interface with the application core.'''
 
@@ -94,6 +138,11 @@ class Core(object):
         self._options = options
         self._profiles_manager = ProfilesManager(data_path, STATIC_PATH)
         self._build_titles_db(data_path, daemon)
+        # The categories and profiles lists, already encoded as the web
+        # service responses. The profiles one is rebuilt when they change
+        self._categories_blob = _json_dumps({
+            'categories': self.get_categories(), 'code': 0})
+        self._update_profiles_blob()
         self._torrent_engine = TorrentEngine(data_path, options)
         self._scheduler = TaskScheduler(options['server']['tasks_interval'],
             self._titles_db, self._torrent_engine, data_path)
@@ -140,17 +189,30 @@ class Core(object):
         '''Return the picture for the given profile.'''
         return self._profiles_manager.get_profile_picture(name)
 
-    def set_profile_picture(self, name, picture=None):
+    async def set_profile_picture(self, name, picture=None):
         '''Set a new profile picture for the given profile.'''
-        self._profiles_manager.set_profile_picture(name, picture)
+        await self._profiles_manager.set_profile_picture(name, picture)
 
-    def create_profile(self, name, picture=None):
+    async def create_profile(self, name, picture=None):
         '''Create a new profile.'''
-        self._profiles_manager.create_profile(name, picture)
+        await self._profiles_manager.create_profile(name, picture)
+        self._update_profiles_blob()
 
     def delete_profile(self, name):
         '''Delete a profile.'''
         self._profiles_manager.delete_profile(name)
+        self._update_profiles_blob()
+
+    def get_profiles_blob(self):
+        '''Return the names of the profiles, encoded as the JSON response of
+        the web service.
+        '''
+        return self._profiles_blob
+
+    def _update_profiles_blob(self):
+        '''Encode again the names of the profiles.'''
+        self._profiles_blob = _json_dumps({
+            'profiles': [p.name for p in self.get_profiles()], 'code': 0})
 
     # Functions to list the medias
 
@@ -158,7 +220,13 @@ class Core(object):
         '''Return the list of videos categories.'''
         return self._titles_db.get_categories_names()
 
-    def top(self, profile, category):
+    def get_categories_blob(self):
+        '''Return the list of videos categories, encoded as the JSON
+        response of the web service.
+        '''
+        return self._categories_blob
+
+    async def top(self, profile, category):
         '''Return the top list of medias of a given category.'''
         # Get the user settings
         settings = self._profiles_manager[profile].settings
@@ -166,14 +234,18 @@ class Core(object):
         # Get the top list of torrents
         category = self._titles_db.get_category(category)
         torrents = self._torrent_engine.top(category, filters)
-        return self._titles_db.get_medias_from_torrents(torrents)
+        return (await self._titles_db.get_medias_from_torrents(torrents))
 
     def get_poster(self, imdb_id):
-        '''Return the poster of a given title.'''
+        '''Return the poster of a given title, as a tuple (data, mtime), or
+        None if it's not stored.
+        '''
         return self._titles_db.get_poster(imdb_id)
 
     async def search(self, category, text):
-        '''Search titles by name in IMDB.'''
+        '''Search titles by name in IMDB. Return the list of titles found
+        and whether the results were truncated.
+        '''
         return (await self._titles_db.search(category, text))
 
     def get_title(self, imdb_id):
@@ -221,6 +293,10 @@ class Core(object):
         '''Return a Video object from a title_id.'''
         return self._titles_db.get_video(imdb_id, season, episode)
 
+    def get_videos_path(self):
+        '''Return the directory where the videos are stored.'''
+        return self._options['videos']['path']
+
 
 class ProfilesManager(object):
     '''Manage the user profiles.'''
@@ -231,6 +307,8 @@ class ProfilesManager(object):
 
     def __init__(self, data_dir, static_dir):
         self._profiles_path = os.path.join(data_dir, self._PROFILES_DIR)
+        # Contents of the profile pictures, as tuples (mtime, data)
+        self._pictures_cache = {}
         # Make sure the self._profiles_path exists
         self._create_profiles_path()
         try:
@@ -268,48 +346,89 @@ class ProfilesManager(object):
         '''Return the picture for the given profile.'''
         if name not in self._profiles:
             raise KeyError("profile '{}' not found".format(name))
-        picture_path = os.path.join(self._profiles_path, name + '.png')
+        picture_path = self._get_picture_path(name)
         try:
-            return open(picture_path, 'rb')
-        except IOError:
+            mtime = os.stat(picture_path).st_mtime_ns
+        except OSError:
+            self._pictures_cache.pop(name, None)
             return None
+        cached = self._pictures_cache.get(name)
+        if cached is None or cached[0] != mtime:
+            try:
+                with open(picture_path, 'rb') as f:
+                    cached = (mtime, f.read())
+            except IOError:
+                return None
+            self._pictures_cache[name] = cached
+        return io.BytesIO(cached[1])
 
-    def set_profile_picture(self, name, picture=None):
+    def _get_picture_path(self, name):
+        '''Return the path of the picture of the given profile.'''
+        return os.path.join(self._profiles_path, name + '.png')
+
+    async def set_profile_picture(self, name, picture=None):
         '''Set a new picture for the given profile.'''
         if name not in self._profiles:
             raise KeyError("profile '{}' not found".format(name))
+        if picture:
+            picture = await self._process_profile_picture(picture)
+            # The profile could have been deleted in the meantime
+            if name not in self._profiles:
+                raise KeyError("profile '{}' not found".format(name))
+        self._pictures_cache.pop(name, None)
         if not picture:
             # Default picture selected. Delete previous picture, if any
             try:
-                picture_path = os.path.join(self._profiles_path, name + '.png')
-                os.unlink(picture_path)
+                os.unlink(self._get_picture_path(name))
             except OSError: pass
         else:
             self._save_profile_picture(name, picture)
 
-    def create_profile(self, name, picture=None):
+    async def create_profile(self, name, picture=None):
         '''Create a new profile with the given name.'''
-        if name not in self._profiles:
-            if picture:
-                self._save_profile_picture(name, picture)
-            self._profiles[name] = UserProfile(name)
-            self._save()
-        else:
+        if name in self._profiles:
             raise ValueError('a profile with this name already exists')
+        if picture:
+            picture = await self._process_profile_picture(picture)
+            # The same profile could have been created in the meantime
+            if name in self._profiles:
+                raise ValueError('a profile with this name already exists')
+            self._save_profile_picture(name, picture)
+        self._profiles[name] = UserProfile(name)
+        self._save()
 
-    def _save_profile_picture(self, name, picture):
-        '''Save a picture to be used as a profile picture.'''
+    async def _process_profile_picture(self, picture):
+        '''Return the given picture scaled down and encoded as PNG.
+        Decoding and scaling the picture is slow, so it's done off the
+        IOLoop. The profiles themselves are only modified in the IOLoop.
+        '''
+        return await tornado.ioloop.IOLoop.current().run_in_executor(
+            None, self._scale_profile_picture, picture)
+
+    def _scale_profile_picture(self, picture):
+        '''Scale down a picture to be used as a profile picture and return
+        it encoded as PNG.
+        '''
         # First try to open it with pillow
         try:
             pic = PIL.Image.open(io.BytesIO(picture))
         except IOError:
             raise IOError('profile picture format unsupported')
-        # Resize it to 256x256
-        pic = pic.resize(self._PROFILE_PICTURE_SIZE)
-        # Save the new picture
+        # Scale it down to fit in 256x256. draft lets the JPEG decoder do
+        # most of the downscaling while decoding (no-op for other formats)
+        pic.draft('RGB', self._PROFILE_PICTURE_SIZE)
+        pic.thumbnail(self._PROFILE_PICTURE_SIZE, PIL.Image.LANCZOS)
+        out = io.BytesIO()
+        pic.save(out, format='PNG', optimize=True)
+        return out.getvalue()
+
+    def _save_profile_picture(self, name, picture):
+        '''Save a picture, already scaled, to be used as a profile
+        picture.
+        '''
         try:
-            picture_path = os.path.join(self._profiles_path, name + '.png')
-            pic.save(picture_path)
+            with open(self._get_picture_path(name), 'wb') as f:
+                f.write(picture)
         except IOError as e:
             raise IOError('cannot write profile picture: {}'.format(e))
 
@@ -317,9 +436,9 @@ class ProfilesManager(object):
         '''Delete the profile with the given name.'''
         try:
             # Delete the profile picture if any
-            picture_path = os.path.join(self._profiles_path, name + '.png')
+            self._pictures_cache.pop(name, None)
             try:
-                os.unlink(picture_path)
+                os.unlink(self._get_picture_path(name))
             except OSError:
                 pass
             del self._profiles[name]
@@ -360,10 +479,12 @@ class Category(object):
         # IMDB types associated with this category (to perform searches in
         # IMDB).
         self.imdb_type = imdb_type
+        # Canonical form of the name
+        self._id = self._RE_KEY.sub('_', name.lower())
 
     def get_id(self):
         '''Return a canonical form of this category's name.'''
-        return self._RE_KEY.sub('_', self.name.lower())
+        return self._id
 
 
 class TitlesDB(object):
@@ -379,72 +500,109 @@ class TitlesDB(object):
     # Name of the IMDBTitle database files
     TITLE_DB_FILE = 'db.json'
 
-    # Accepted videos
-    VIDEO_EXTENSIONS = ['mp4']
+    # Accepted videos (files suffixes)
+    VIDEO_EXTENSIONS = ('.mp4',)
+
+    # Maximum number of simultaneous requests to IMDB
+    MAX_CONCURRENT_FETCHES = 8
+
+    # Maximum number of results of a search
+    MAX_SEARCH_RESULTS = 20
 
     def __init__(self, categories, videos_path, data_path):
         self._categories = dict((c.name, c) for c in categories)
+        # The categories don't change, keep their sorted names
+        self._categories_names = tuple(sorted(self._categories))
         self._root_path = videos_path
         # Give the videos path to the Title class
         self._data_path = data_path
+        self._torrents_to_imdb_file = os.path.join(
+            data_path, self.TORRENTS_TO_IMDB_FILE)
+        self._titles_not_found_file = os.path.join(
+            data_path, self.TITLES_NOT_FOUND_FILE)
+        # Ids of the titles with a database file (loaded lazily), and the
+        # modification time of the root directory when they were listed
+        self._titles_ids = None
+        self._titles_ids_mtime = None
+        # Videos of each title, indexed when its directory was last listed:
+        # imdb_id -> (mtime, first video, {(season, episode): path})
+        self._videos_cache = {}
         self._load_torrents_to_imdb()
         self._load_titles_not_found()
 
-    def _get_torrents_to_imdb_file(self):
-        '''Return torrents to imdb id file.'''
-        return os.path.join(self._data_path, self.TORRENTS_TO_IMDB_FILE)
-
-    def _get_titles_not_found_file(self):
-        '''Return the titles not found file.'''
-        return os.path.join(self._data_path, self.TITLES_NOT_FOUND_FILE)
-
     def get_category(self, category):
         '''Return a category by its name.'''
         return self._categories[category]
 
     def get_categories_names(self):
-        '''Return a list with the names of the categories.'''
-        return sorted(self._categories.keys())
+        '''Return a tuple with the sorted names of the categories.'''
+        return self._categories_names
 
-    def get_medias_from_torrents(self, torrents):
+    async def get_medias_from_torrents(self, torrents):
         '''Return a list of medias from a list of torrents.'''
-        # Get the list of titles
-        titles = [self._get_title_from_torrent_cached(t)
-            for t in torrents]
-        # Discard the titles not found
-        titles_torrents = [(tit, tor) for tit, tor in zip(titles, torrents)
-            if tit is not None]
-        # Get the media corresponding to each title
-        medias = [title.get_media(torrent)
-            for title, torrent in titles_torrents]
-        # Remove repeated medias and null ones (keep its order)
-        set_medias = set()
-        final_medias = []
-        for m in medias:
-            if m is not None:
-                if m not in set_medias:
-                    final_medias.append(m)
-                    set_medias.add(m)
-        return final_medias
-
-    def _get_title_from_torrent_cached(self, torrent):
-        '''Retrieves a title from the torrent name.'''
+        # Get the list of titles (each different title is loaded only once)
+        imdb_ids = [self._get_imdb_id_from_torrent(t) for t in torrents]
+        titles = await self._load_titles(imdb_ids)
+        # Get the media corresponding to each torrent whose title was found,
+        # discarding the repeated and null ones (keep its order)
+        medias = dict.fromkeys(titles[i].get_media(t)
+            for i, t in zip(imdb_ids, torrents) if i in titles)
+        medias.pop(None, None)
+        return list(medias)
+
+    def _get_imdb_id_from_torrent(self, torrent):
+        '''Return the imdb id of the title of a torrent, or None if it's not
+        known.
+        '''
+        return self._torrents_to_imdb.get(self._get_torrent_key(torrent))
+
+    async def _load_titles(self, imdb_ids):
+        '''Load the titles with the given ids.
+
+        The titles databases are read in parallel in a thread pool, so the
+        IOLoop is not blocked. Return a dictionary with the titles found,
+        indexed by their id.
+        '''
+        imdb_ids = [i for i in set(imdb_ids) if i is not None]
+        # Scan the titles path before going multithread
+        self._get_titles_ids()
+        io_loop = tornado.ioloop.IOLoop.current()
+        titles = await asyncio.gather(*[io_loop.run_in_executor(
+            None, self._get_title_or_none, i) for i in imdb_ids])
+        return dict((i, t) for i, t in zip(imdb_ids, titles) if t is not None)
+
+    def _get_title_or_none(self, imdb_id):
+        '''Return a title given its imdb_id, or None if it's not found.'''
         try:
-            torrent_key = self._get_torrent_key(torrent)
-            imdb_id = self._torrents_to_imdb[torrent_key]
-            # ID found, build the Title instance
-            title = self.get_title(imdb_id)
+            return self.get_title(imdb_id)
         except KeyError:
-            title = None
-        return title
-
-    async def fetch_title_from_torrent(self, torrent, category):
-        '''Fetch a title from a torrent.'''
-        # Get the title
-        imdb_title = await self._get_title_from_torrent(torrent, category)
-        if imdb_title is not None:
-            await self._imdb_title_fetch_and_save(imdb_title)
-        return imdb_title
+            return None
+
+    async def fetch_titles_from_torrents(self, torrents, category):
+        '''Fetch the titles from a list of torrents.
+
+        Each title is looked up and fetched only once, even if several
+        torrents refer to it, and the number of simultaneous requests to IMDB
+        is bounded.
+        '''
+        semaphore = asyncio.Semaphore(self.MAX_CONCURRENT_FETCHES)
+        # Look up the title of each different torrent key
+        torrents = dict((self._get_torrent_key(t), t) for t in torrents)
+        imdb_titles = await asyncio.gather(*[self._bounded(
+            semaphore, self._get_title_from_torrent(t, category))
+            for t in torrents.values()])
+        # Fetch each different title
+        imdb_titles = dict((t.id, t) for t in imdb_titles if t is not None)
+        await asyncio.gather(*[self._bounded(
+            semaphore, self._imdb_title_fetch_and_save(t))
+            for t in imdb_titles.values()])
+        return list(imdb_titles.values())
+
+    @staticmethod
+    async def _bounded(semaphore, coroutine):
+        '''Await coroutine while holding semaphore.'''
+        async with semaphore:
+            return await coroutine
 
     async def _imdb_title_fetch_and_save(
             self, imdb_title, fetch_pictures=True):
@@ -469,9 +627,9 @@ class TitlesDB(object):
             # ID not found in the cache
             # If it is in the 'not found' list, don't look any further
             if torrent_key not in self._titles_not_found:
+                info = torrent.name_info
                 results = await tvfamily.imdb.search(
-                    torrent.name_info['title'], category.imdb_type,
-                    torrent.name_info.get('year'))
+                    info['title'], category.imdb_type, info.get('year'), 1)
                 if len(results):
                     imdb_title = results[0]
                     self._torrents_to_imdb[torrent_key] = results[0].id
@@ -483,8 +641,8 @@ class TitlesDB(object):
     def _load_imdb_title(self, imdb_id):
         '''Load an IMDBTitle info from its id.'''
         db_path = os.path.join(self._root_path, imdb_id, self.TITLE_DB_FILE)
-        with open(db_path, 'r') as f:
-            attrs = json.loads(f.read())
+        with open(db_path, 'rb') as f:
+            attrs = _json_loads(f.read())
         return tvfamily.imdb.IMDBTitle(imdb_id, attrs)
 
     def _create_db_path(self, title_path):
@@ -498,8 +656,28 @@ class TitlesDB(object):
         try:
             with open(db_path, 'w') as f:
                 f.write(json.dumps(imdb_title._attrs))
+            self._get_titles_ids().add(imdb_title.id)
         except IOError: pass
 
+    def _get_titles_ids(self):
+        '''Return the set of ids of the titles stored in disk. The set is
+        built again when the root directory is modified.
+        '''
+        try:
+            mtime = os.stat(self._root_path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if self._titles_ids is None or mtime != self._titles_ids_mtime:
+            try:
+                with os.scandir(self._root_path) as entries:
+                    self._titles_ids = set(e.name for e in entries
+                        if e.is_dir() and os.path.exists(
+                            os.path.join(e.path, self.TITLE_DB_FILE)))
+            except OSError:
+                self._titles_ids = set()
+            self._titles_ids_mtime = mtime
+        return self._titles_ids
+
     def _get_title_path(self, title_id):
         '''Return the path where the information of a title is stored.'''
         return os.path.join(self._root_path, title_id)
@@ -509,58 +687,66 @@ class TitlesDB(object):
         file.
         '''
         try:
-            with open(self._get_torrents_to_imdb_file(), 'r') as f:
+            with open(self._torrents_to_imdb_file, 'r') as f:
                 self._torrents_to_imdb = json.loads(f.read())
         except IOError:
             self._torrents_to_imdb = {}
 
     def _save_torrents_to_imdb(self):
         '''Write the torrents to imdb ids mapping to its file.'''
-        with open(self._get_torrents_to_imdb_file(), 'w') as f:
+        with open(self._torrents_to_imdb_file, 'w') as f:
             f.write(json.dumps(self._torrents_to_imdb))
 
     def _get_torrent_key(self, torrent):
         '''Return a key to be used in the torrents_to_imdb database.'''
-        k = torrent.name_info['title'].lower()
-        try:
-            k = '{}.{}'.format(k, str(torrent.name_info['year']))
-        except KeyError: pass
+        info = torrent.name_info
+        k = info['title'].lower()
+        year = info.get('year')
+        if year is not None:
+            k = '{}.{}'.format(k, year)
         return k
 
     def get_title(self, imdb_id):
         '''Return a title given its imdb_id.'''
+        titles_ids = self._get_titles_ids()
+        # Don't even try to open the database of an unknown title
+        if imdb_id not in titles_ids:
+            raise KeyError('title with imdb_id {} not found'.format(imdb_id))
         try:
             t = Title(self._load_imdb_title(imdb_id))
             t.set_path(self._get_title_path(imdb_id))
             return t
         except IOError:
+            titles_ids.discard(imdb_id)
             raise KeyError('title with imdb_id {} not found'.format(imdb_id))
 
     def get_poster(self, imdb_id):
-        '''Return a file descriptor to the poster image for this title.'''
+        '''Return the poster image for this title, as a tuple (data, mtime),
+        or None if it is not stored.
+        '''
         title = self.get_title(imdb_id)
-        base_name = title.get_poster_url().rpartition('/')[-1]
-        try:
-            f = open(os.path.join(title.get_path(), base_name), 'rb')
-        except IOError:
-            base_name = title.get_poster_url_small().rpartition('/')[-1]
+        # Try the big poster first, then the small one
+        for get_url in (title.get_poster_url, title.get_poster_url_small):
+            path = os.path.join(
+                title.get_path(), get_url().rpartition('/')[-1])
             try:
-                f = open(os.path.join(title.get_path(), base_name), 'rb')
-            except IOError:
-                f = None
-        return f
+                mtime = os.stat(path).st_mtime_ns
+                return _read_poster(path, mtime), mtime
+            except OSError:
+                pass
+        return None
 
     def _load_titles_not_found(self):
         '''Load the list of titles not found in IMDB.'''
         try:
-            with open(self._get_titles_not_found_file(), 'r') as f:
+            with open(self._titles_not_found_file, 'r') as f:
                 self._titles_not_found = set(json.loads(f.read()))
         except IOError:
             self._titles_not_found = set()
 
     def _save_titles_not_found(self):
         '''Write the list of titles not found in IMDB to its file.'''
-        with open(self._get_titles_not_found_file(), 'w') as f:
+        with open(self._titles_not_found_file, 'w') as f:
             f.write(json.dumps(list(self._titles_not_found)))
 
     def save_databases(self):
@@ -569,54 +755,84 @@ class TitlesDB(object):
         self._save_titles_not_found()
 
     async def search(self, category, text):
-        '''Search titles by name in IMDB.'''
+        '''Search titles by name in IMDB.
+
+        Return the list of titles found and True if there were more than
+        MAX_SEARCH_RESULTS results (the rest are discarded). The results are
+        fetched concurrently, but the number of simultaneous requests to IMDB
+        is bounded. The results that cannot be fetched are discarded.
+        '''
         category = self._categories[category]
-        results = await tvfamily.imdb.search(text, category.imdb_type)
-        await tornado.gen.multi(
-            [self._imdb_title_fetch_and_save(x, False) for x in results])
-        titles = [Title(x) for x in results]
-        return titles
+        # Ask for one more result, to know if there are more than the maximum
+        results = await tvfamily.imdb.search(
+            text, category.imdb_type, limit=self.MAX_SEARCH_RESULTS + 1)
+        truncated = len(results) > self.MAX_SEARCH_RESULTS
+        results = results[:self.MAX_SEARCH_RESULTS]
+        semaphore = asyncio.Semaphore(self.MAX_CONCURRENT_FETCHES)
+        errors = await asyncio.gather(*[self._bounded(
+            semaphore, self._imdb_title_fetch_and_save(x, False))
+            for x in results], return_exceptions=True)
+        titles = []
+        for x, e in zip(results, errors):
+            if e is None:
+                titles.append(Title(x))
+            else:
+                logging.warning('cannot fetch title {}: {}'.format(x.id, e))
+        return titles, truncated
 
     def has_video(self, title_id, season=None, episode=None):
         '''Return True if the file for this media is downloaded.'''
         return self.get_video(title_id, season, episode) is not None
 
     def get_video(self, imdb_id, season=None, episode=None):
-        '''Return the video in the local machine, if any, for this media.'''
-        path = self._get_title_path(imdb_id)
-        if os.path.exists(path):
-            if len(self.VIDEO_EXTENSIONS) == 1:
-                videos_wilcard = '*.{}'.format(self.VIDEO_EXTENSIONS[0])
-            else:
-                videos_wilcard = '*.{{{}}}'.format(
-                    ','.join[self.VIDEO_EXTENSIONS])
-            videos = glob.glob(os.path.join(path, videos_wilcard))
-            video = None
-            if videos:
-                if season is None or episode is None:
-                    video = Video(videos[0])
-                else:
-                    for v in videos:
-                        info = tvfamily.PTN.parse(os.path.basename(v))
-                        try:
-                            s, e = info['season'], info['episode']
-                            if s == season and e == episode:
-                                video = Video(v)
-                                break
-                        except KeyError:
-                            pass
-        else:
+        '''Return the video in the local machine, if any, for this media.
+
+        The videos of each title are indexed until the title's directory
+        is modified, so the directory is not listed again on every request.
+        '''
+        title_path = self._get_title_path(imdb_id)
+        try:
+            mtime = os.stat(title_path).st_mtime_ns
+            cached = self._videos_cache.get(imdb_id)
+            if cached is None or cached[0] != mtime:
+                cached = (mtime,) + self._index_videos(title_path)
+                self._videos_cache[imdb_id] = cached
+        except OSError:
             raise KeyError('Unknown media')
-        return video
+        _, first, episodes = cached
+        if season is None or episode is None:
+            path = first
+        else:
+            path = episodes.get((season, episode))
+        return None if path is None else Video(path)
+
+    def _index_videos(self, title_path):
+        '''Return the path of the first video in title_path (None if there
+        are no videos) and a dictionary that maps each (season, episode) to
+        the path of its video.
+        '''
+        first = None
+        episodes = {}
+        with os.scandir(title_path) as entries:
+            for e in entries:
+                if e.name.endswith(self.VIDEO_EXTENSIONS) and e.is_file():
+                    if first is None:
+                        first = e.path
+                    info = tvfamily.torrent.parse_name(e.name)
+                    episodes.setdefault(
+                        (info.get('season'), info.get('episode')), e.path)
+        return first, episodes
 
 
 class Video(object):
     '''Represents a video (movie or tv series episode).'''
 
-    _CHUNK_SIZE = 64 * 1024
+    _CHUNK_SIZE = 1024 * 1024
 
     def __init__(self, path):
         self.path = path
+        self._size = None
+        self._mtime_ns = None
 
     """@property
     def container(self):
@@ -626,35 +842,65 @@ class Video(object):
                 os.path.basename(self.path))['container']
         return self._container"""
 
-    def get_content(self, start=None, end=None):
+    def open(self):
+        '''Open the video file for reading and update its size and
+        modification time from it.
+
+        The file is not buffered, the reads are already large and a buffer
+        would only add an extra copy of the data.
+        '''
+        f = open(self.path, 'rb', buffering=0)
+        st = os.fstat(f.fileno())
+        self._size, self._mtime_ns = st.st_size, st.st_mtime_ns
+        return f
+
+    def _advise_sequential(self, f, start, end=None):
+        '''Tell the kernel that f will be read sequentially from start to
+        end, so it uses a larger readahead window. It's only a hint, it's
+        skipped where posix_fadvise is not available.
+        '''
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), start,
+                0 if end is None else end - start, os.POSIX_FADV_SEQUENTIAL)
+
+    def get_content(self, f, start=None, end=None):
         '''Return an iterator that generates the bytes from this video,
-        from start to end, by chunks.
+        read from its opened file f, from start to end, by chunks.
         '''
-        read = 0
-        to_read = self._CHUNK_SIZE
-        with open(self.path, "rb") as f:
-            start = start or 0
-            f.seek(start)
-            while end is None or start + read < end:
-                if end and start + read + to_read > end:
-                    to_read = end - start - read
-                chunk = f.read(to_read)
-                if chunk:
-                    read += len(chunk)
-                    yield chunk
-                else:
-                    if end is None:
-                        return
-                    assert start + read == end
+        start = start or 0
+        self._advise_sequential(f, start, end)
+        f.seek(start)
+        if end is None:
+            # Read until the end of the file
+            chunk = f.read(self._CHUNK_SIZE)
+            while chunk:
+                yield chunk
+                chunk = f.read(self._CHUNK_SIZE)
+        else:
+            remaining = end - start
+            while remaining > 0:
+                chunk = f.read(min(self._CHUNK_SIZE, remaining))
+                if not chunk:
                     return
+                remaining -= len(chunk)
+                yield chunk
 
     """def get_mime_type(self):
         '''Return the mime type that corresponds to this video.'''
         return 'video/{}'.format(self.container)"""
 
+    def get_mtime_ns(self):
+        '''Return the modification time of this video file, in nanoseconds.
+        '''
+        if self._mtime_ns is None:
+            self._mtime_ns = os.stat(self.path).st_mtime_ns
+        return self._mtime_ns
+
     def get_size(self):
         '''Return the size of this video file.'''
-        return os.path.getsize(self.path)
+        if self._size is None:
+            self._size = os.path.getsize(self.path)
+        return self._size
 
     """def get_subtitles(self):
         '''Return the available subtitles for this video.'''
@@ -685,10 +931,10 @@ class Title(object):
     def __init__(self, imdb_title):
         self.imdb_title = imdb_title
         self.path = None
-        if self.imdb_title['type'] in Movie.TYPES:
-            self.type = Movie(self)
-        else:
-            self.type = TVSerie(self)
+        self._hash = hash(imdb_title.id)
+        self.type = _TITLE_TYPES.get(imdb_title['type'], TVSerie)(self)
+        # Dictionary with the attributes of this title (built lazily)
+        self._dict = None
 
     def __eq__(self, other):
         '''Two episodes are the same if they are from the same title and
@@ -697,7 +943,7 @@ class Title(object):
         return self.imdb_title.id == other.imdb_title.id
 
     def __hash__(self):
-        return hash(self.imdb_title.id)
+        return self._hash
 
     def get_air_year(self):
         return self.imdb_title['air_year']
@@ -737,13 +983,17 @@ class Title(object):
         self.path = path
 
     def todict(self):
-        '''Return a dictionary with some of the attributes of this instance.'''
-        d = {'title': self.get_title(), 'title_id': self.imdb_title.id,
-            'rating': self.get_rating(), 'air_year': self.get_air_year(),
-            'end_year': self.get_end_year(), 'genre': self.get_genre(),
-            'plot': self.get_plot()}
-        d.update(self.type.todict())
-        return d
+        '''Return a dictionary with some of the attributes of this instance.
+        It's built only once, so it must not be modified.
+        '''
+        if self._dict is None:
+            d = {'title': self.get_title(), 'title_id': self.imdb_title.id,
+                'rating': self.get_rating(), 'air_year': self.get_air_year(),
+                'end_year': self.get_end_year(), 'genre': self.get_genre(),
+                'plot': self.get_plot()}
+            d.update(self.type.todict())
+            self._dict = d
+        return self._dict
 
 
 class TVSerie(object):
@@ -771,9 +1021,10 @@ class TVSerie(object):
 
     def get_media(self, torrent):
         '''Return this tv series' episode related to the torrent.'''
+        info = torrent.name_info
         try:
-            season = torrent.name_info['season']
-            episode = torrent.name_info['episode']
+            season = info['season']
+            episode = info['episode']
             # Verify that this season and episode exists
             e = self.title.imdb_title['seasons'][str(season)][str(episode)]
             return Episode(self.title, season, episode)
@@ -807,6 +1058,7 @@ class Episode(object):
         self.title = title
         self.season = season
         self.episode = episode
+        self._hash = hash((title.imdb_title.id, season, episode))
 
     def __eq__(self, other):
         '''Two episodes are the same if they are from the same title and
@@ -816,7 +1068,7 @@ class Episode(object):
             and self.season == other.season and self.episode == other.episode)
 
     def __hash__(self):
-        return hash((self.title.imdb_title.id, self.season, self.episode))
+        return self._hash
 
     """def __str__(self):
         return '{} {}x{:02d}'.format(
@@ -833,7 +1085,7 @@ class Episode(object):
 
     def todict(self):
         '''Return a dictionary with some of the attributes of this instance.'''
-        d = self.title.todict()
+        d = dict(self.title.todict())
         d.update({'season': self.season, 'episode': self.episode})
         return d
 
@@ -870,6 +1122,11 @@ class Movie(object):
         return Video(path)"""
 
 
+# Class that implements each type of IMDB title (TVSerie by default)
+_TITLE_TYPES = dict([(t, Movie) for t in Movie.TYPES]
+    + [(t, TVSerie) for t in TVSerie.TYPES])
+
+
 class MediaStatus(object):
     '''Return the on disk status of a media.'''
 
@@ -888,6 +1145,30 @@ class MediaStatus(object):
             'progress': self.progress}
 
 
+class _ValueClassifier(object):
+    '''Classify the values of a torrent attribute, given the regex that
+    identifies each class. The results are cached.
+    '''
+
+    def __init__(self, classes, regexes):
+        self.classes = frozenset(classes)
+        # A single regex with one named group per class
+        self._groups = dict(
+            ('v{}'.format(i), c) for i, c in enumerate(classes))
+        self._regex = re.compile('|'.join('(?P<v{}>{})'.format(i, r.pattern)
+            for i, r in enumerate(regexes)), re.I)
+        self._cache = {}
+
+    def classify(self, value):
+        '''Return the class of value, or None if it doesn't match any.'''
+        try:
+            return self._cache[value]
+        except KeyError:
+            m = self._regex.match(value)
+            c = self._cache[value] = self._groups[m.lastgroup] if m else None
+            return c
+
+
 class TorrentEngine(object):
     '''Manages the plugins that interface with the torrents sites.
     Interface with the torrents sites (via the different plugins).
@@ -924,14 +1205,31 @@ class TorrentEngine(object):
     _FILTER_CODEC = dict(zip(_CODEC_VALUES, _RE_CODEC))
     _FILTER_RESOLUTION = dict(zip(_RESOLUTION_VALUES, _RE_RESOLUTION))
 
+    # Torrent attributes filtered by value, in the order of the filters tuple,
+    # with the classifier of its values
+    _FILTERS = [
+        ('quality', _ValueClassifier(_QUALITY_VALUES, _RE_QUALITY)),
+        ('codec', _ValueClassifier(_CODEC_VALUES, _RE_CODEC)),
+        ('resolution', _ValueClassifier(_RESOLUTION_VALUES, _RE_RESOLUTION)),
+    ]
+
     _SLEEP_INTERVAL = 2
 
+    # Key to sort the torrents by seeders
+    _SEEDERS = operator.attrgetter('seeders')
+
     def __init__(self, data_path, options):
         self.data_path = data_path
         # Path to the plugins files
         self._plugins_path = options['plugins']['path']
         # List of plugins (modules) sorted by name
         self._plugins = []
+        # Plugins (modules) indexed by name
+        self._plugins_by_name = {}
+        # Modification time of the plugins path when it was last scanned
+        self._plugins_mtime = None
+        # Serializes the plugins reloads
+        self._plugins_lock = tornado.locks.Lock()
         # Global options
         self._options = options
         # Dictionary of downloads
@@ -953,7 +1251,7 @@ class TorrentEngine(object):
             torrents = []
         # Filter and sort the list of torrents
         return sorted(self._filter(torrents, filters),
-            key=lambda x: x.seeders, reverse=True)
+            key=self._SEEDERS, reverse=True)
 
     def _get_torrents_list_file(self, category):
         '''Return the name of the file that contains the list of torrents of
@@ -965,37 +1263,41 @@ class TorrentEngine(object):
     def _filter(self, torrents, filters):
         '''Filter a list of torrents according to its values of quality, codec,
         resolution and 3D.
+
+        An attribute with all its values selected is not filtered.
         '''
         if filters is None:
-            l = torrents
-        else:
-            quality, codec, resolution, _3d = filters
-            l = self._filter_from_attr(
-                torrents, quality, 'quality', self._FILTER_QUALITY)
-            l = self._filter_from_attr(l, codec, 'codec', self._FILTER_CODEC)
-            l = self._filter_from_attr(
-                l, resolution, 'resolution', self._FILTER_RESOLUTION)
-            l = [t for t in l if _3d is None
-                or not t.name_info.get('3d', False) or '3D' in _3d]
-        return l
-
-    def _filter_from_attr(self, torrents, filter, attr, dictionary):
-        '''Filter a list of torrents by a given attribute.'''
-        if filter is None:
-            l = torrents
-        else:
-            l = []
-            for t in torrents:
-                for f in filter:
-                    value = t.name_info.get(attr)
-                    if value is None or dictionary[f].match(value):
-                        l.append(t)
-                        break
+            return torrents
+        # The filtered attributes, with their classifier and selected values
+        selected = []
+        for (attr, classifier), values in zip(self._FILTERS, filters):
+            if values is not None:
+                if not values:
+                    # No value accepted for this attribute
+                    return []
+                values = frozenset(values)
+                if not values >= classifier.classes:
+                    selected.append((attr, classifier, values))
+        _3d = filters[3] is None or '3D' in filters[3]
+        if not selected and _3d:
+            return torrents
+        # Check all the attributes of each torrent in a single pass
+        l = []
+        for t in torrents:
+            info = t.name_info
+            for attr, classifier, values in selected:
+                value = info.get(attr)
+                if (value is not None
+                        and classifier.classify(value) not in values):
+                    break
+            else:
+                if _3d or not info.get('3d', False):
+                    l.append(t)
         return l
 
     async def fetch_top(self, category):
         '''Fetch the top list of torrents for a given category.'''
-        self._reload_plugins()
+        await self._reload_plugins()
         results = await tornado.gen.multi([self._plugin_method_wrapper(
             p.top, category.name, self._options) for p in self._plugins])
         # Flatten the list of torrents
@@ -1010,48 +1312,53 @@ class TorrentEngine(object):
                 f.write(json.dumps([t.todict() for t in torrents]))
         return torrents
 
-    def _reload_plugins(self):
+    async def _reload_plugins(self):
         '''Called before each operation. Load new modules in plugins_path
         and unload the removed ones.
+
+        The new modules are loaded in parallel in a thread pool, so the
+        IOLoop is not blocked by their initialization. Concurrent callers
+        wait for the reload in progress to finish.
         '''
-        try:
-            plugins = []
-            # Get the plugins path
-            plugins_path = self._options['plugins']['path']
-            # List the current plugins in the directory and sort it by name
-            # Return if the list of plugins cannot be read
-            plugins_files = sorted([x for x in os.listdir(plugins_path)
-                if x.endswith('.py') and not x.startswith('~')])
-            plugins_names = [x.__name__ for x in self._plugins]
-            # Add a sentinel to the current plugins names list
-            plugins_names.append('~')
-            i, j = 0, 0
-            while i < len(plugins_files):
-                new_plugin_name = plugins_files[i].rsplit('.', 1)[0]
-                if new_plugin_name == plugins_names[j]:
-                    # This plugin is already loaded
-                    plugins.append(self._plugins[j])
-                    i, j = i + 1, j + 1
-                elif new_plugin_name < plugins_names[j]:
-                    # This plugin is new, load it
-                    plugin_file = os.path.join(plugins_path, plugins_files[i])
-                    # TODO: Error loading this plugin
-                    spec = importlib.util.spec_from_file_location(
-                        new_plugin_name, plugin_file)
-                    m = importlib.util.module_from_spec(spec)
-                    spec.loader.exec_module(m)
-                    plugins.append(m)
-                    i += 1
-                else:
-                    # A plugin not used anymore
-                    j += 1
-        except KeyError:
-            logging.error('cannot reload torrent plugins: '
-                'plugins path not defined')
-        except IOError as e:
-            logging.error('cannot list plugins in {}: {}'.format(
-                plugins_path, e))
-        self._plugins = plugins
+        async with self._plugins_lock:
+            try:
+                # Nothing to do if the plugins path hasn't changed
+                mtime = os.stat(self._plugins_path).st_mtime_ns
+                if mtime == self._plugins_mtime:
+                    return
+                with os.scandir(self._plugins_path) as it:
+                    plugins_names = set(e.name[:-3] for e in it
+                        if e.name.endswith('.py')
+                        and not e.name.startswith('~') and e.is_file())
+            except OSError as e:
+                logging.error('cannot list plugins in {}: {}'.format(
+                    self._plugins_path, e))
+                mtime = None
+                plugins_names = set()
+            # Load the new plugins and unload the removed ones
+            removed = self._plugins_by_name.keys() - plugins_names
+            added = list(plugins_names - self._plugins_by_name.keys())
+            if removed or added:
+                io_loop = tornado.ioloop.IOLoop.current()
+                modules = await asyncio.gather(*[io_loop.run_in_executor(
+                    None, self._load_plugin, n) for n in added])
+                for n in removed:
+                    del self._plugins_by_name[n]
+                self._plugins_by_name.update(zip(added, modules))
+                self._plugins = [self._plugins_by_name[n]
+                    for n in sorted(self._plugins_by_name)]
+            # Record the mtime only once the plugins are loaded, so a
+            # failed load is retried in the next call
+            self._plugins_mtime = mtime
+
+    def _load_plugin(self, name):
+        '''Load the plugin module with the given name.'''
+        # TODO: Error loading this plugin
+        spec = importlib.util.spec_from_file_location(
+            name, os.path.join(self._plugins_path, name + '.py'))
+        m = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(m)
+        return m
 
     async def _plugin_method_wrapper(self, method, *args):
         '''Wrapper to call a method of a plugin and avoid exception
@@ -1071,17 +1378,20 @@ class TorrentEngine(object):
             self._RESOLUTION_VALUES, self._3D_VALUES)
 
     async def search(self, query, filters):
-        '''Search torrents by string.'''
-        self._reload_plugins()
+        '''Search torrents by string. Return them sorted by seeders.'''
+        return sorted(await self._search(query, filters),
+            key=self._SEEDERS, reverse=True)
+
+    async def _search(self, query, filters):
+        '''Search torrents by string. Return them unsorted.'''
+        await self._reload_plugins()
         results = await tornado.gen.multi(
             [self._plugin_method_wrapper(p.search, query, self._options)
             for p in self._plugins])
-        torrents = []
-        for r in results:
-            if r is not None:
-                torrents.extend(self._filter(r, filters))
-        torrents.sort(key=lambda x: x.seeders, reverse=True)
-        return torrents
+        # Join the results of all the plugins and filter them at once
+        torrents = list(itertools.chain.from_iterable(
+            r for r in results if r is not None))
+        return self._filter(torrents, filters)
 
     def get_file_status(self, imdb_id, season=None, episode=None):
         '''Return the downloading status of a file.'''
@@ -1117,7 +1427,7 @@ class TorrentEngine(object):
         '''Adds the media download in background.'''
         # Search the torrents for this media
         media_download.status = 'Searching torrents...'
-        torrents = await self.search(media_download.get_query(), filters)
+        torrents = await self._search(media_download.get_query(), filters)
         for t in torrents:
             print(t)
         if not torrents:
@@ -1128,7 +1438,8 @@ class TorrentEngine(object):
             media_download.status = 'Downloading metadata...'
             params = {'save_path': media_download.title.get_path()}
             media_download.handle = libtorrent.add_magnet_uri(
-                self._session, torrents[0].magnet, params)
+                self._session, max(torrents, key=self._SEEDERS).magnet,
+                params)
 
     async def _manage_downloads(self):
         '''Periodicaly check the downloads unitl all of them have finished.'''
@@ -1233,7 +1544,5 @@ class TaskScheduler(object):
         # Fetch list of torrents
         torrents = await self.torrents_engine.fetch_top(category)
         # Then fetch the title that corresponds to each torrent
-        await tornado.gen.multi(
-            [self.titles_db.fetch_title_from_torrent(t, category)
-            for t in torrents])
+        await self.titles_db.fetch_titles_from_torrents(torrents, category)
 
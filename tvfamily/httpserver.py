@@ -22,7 +22,7 @@ import argparse
 import json
 import logging
 import os
-import random
+import secrets
 import signal
 import sys
 
@@ -39,10 +39,14 @@ __status__ = 'Development'
 
 DEFAULT_CONFIG_FILE = os.path.join('/etc', os.path.basename(sys.argv[0]))
 SECRET_BITS = 128
+# Maximum number of simultaneous outgoing HTTP requests (IMDB and plugins)
+MAX_HTTP_CLIENTS = 64
 
-# Select libcurl implementation for HTTP requests
+# Select libcurl implementation for HTTP requests. Its multi handle keeps
+# the connections alive between requests
 tornado.httpclient.AsyncHTTPClient.configure(
-    "tornado.curl_httpclient.CurlAsyncHTTPClient")
+    "tornado.curl_httpclient.CurlAsyncHTTPClient",
+    max_clients=MAX_HTTP_CLIENTS)
 
 class HTTPServerError(Exception): pass
 
@@ -67,8 +71,8 @@ class HTTPServer(object):
             print('error:', msg, file=sys.stderr)
             raise HTTPServerError(msg)
         # Instantiate the application
-        settings['cookie_secret'] = '{:x}'.format(
-            random.getrandbits(SECRET_BITS))
+        settings = dict(settings,
+            cookie_secret=secrets.token_hex(SECRET_BITS // 8))
         self._app = tornado.web.Application(**settings)
         # Handle signals
         def signal_handler(signum, frame):
@@ -20,6 +20,7 @@ along with tvfamily; see the file COPYING.  If not, see
 <http://www.gnu.org/licenses/>.
 '''
 
+import collections
 import html.parser
 import json
 import logging
@@ -27,8 +28,17 @@ import os
 import re
 import tornado.gen
 import tornado.httpclient
+import tornado.ioloop
+import tornado.locks
 import urllib.parse
 
+# Use orjson to decode the titles' JSON-LD if it's available
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
 __author__ = 'Antonio Serrano Hernandez'
 __copyright__ = 'Copyright (C) 2018 2019 Antonio Serrano Hernandez'
 __version__ = '0.1'
@@ -39,7 +49,23 @@ __status__ = 'Development'
 __homepage__ = 'https://github.com/aserranoh/tvfamily'
 
 
-_HTTP_HEADERS = {'Accept-Language': 'en-US'}
+_HTTP_HEADERS = {'Accept-Language': 'en-US', 'Connection': 'keep-alive'}
+# Timeouts for the requests to IMDB, in seconds
+_CONNECT_TIMEOUT = 5
+_REQUEST_TIMEOUT = 30
+# Last responses from IMDB, to revalidate them instead of downloading them
+# again: url -> (etag, last_modified, body). The cache is bounded by the
+# total size of the bodies, in bytes
+_RESPONSES_CACHE = collections.OrderedDict()
+_RESPONSES_CACHE_MAX_BYTES = 16 * 1024 * 1024
+_responses_cache_bytes = 0
+# Maximum number of simultaneous requests to IMDB
+_MAX_CONCURRENT_REQUESTS = 6
+_REQUESTS_SEMAPHORE = tornado.locks.Semaphore(_MAX_CONCURRENT_REQUESTS)
+# Attempts of a request throttled by IMDB (429 or 503 status), and maximum
+# time to wait between attempts, in seconds
+_MAX_ATTEMPTS = 4
+_MAX_RETRY_DELAY = 30
 _IMDB_SEARCH_URL = 'https://www.imdb.com/find'
 _IMDB_TITLE_URL = 'https://www.imdb.com/title/{}'
 _IMDB_SEASON_URL = (
@@ -51,7 +77,7 @@ _RE_SEARCH_TYPE = re.compile(r'\(({})\)'.format('|'.join(_SEARCH_TYPES)))
 # Add 'Movie' as search type (in IMDB movies don't have explicit type)
 _SEARCH_TYPES.append('Movie')
 _RE_TITLE_TYPE_YEAR = re.compile(r'''
-    \( (?: (?P<type> [a-zA-Z ]+? ) \s+ )?
+    \( (?: (?P<type> [a-zA-Z -]+? ) \s+ )?
     (?P<air_year> \d{4} )
     (?: – (?P<end_year> \d{4} | \s* ) )?
     \)
@@ -60,26 +86,100 @@ _RE_TITLE = re.compile(r'(?P<title>.*?) - IMDb')
 _RE_DURATION = re.compile(r'PT(?P<h>\d+)H(?P<m>\d+)M')
 _RE_SEASON = re.compile(r'/title/[^/]+/episodes\?season=(?P<season>\d+)')
 
+async def _fetch(url, **kwargs):
+    '''Fetch an IMDB url and return the body of the response. kwargs are
+    additional arguments for the AsyncHTTPClient.fetch method.
+
+    The AsyncHTTPClient instance is shared by all the requests (it's unique
+    per IOLoop), so the connections to IMDB are reused. The responses that
+    carry validators are remembered, and requested again conditionally.
+    The number of simultaneous requests is bounded, and the requests
+    throttled by IMDB are retried with an exponential backoff (except the
+    streamed ones, whose body has been already consumed).
+    '''
+    headers = _HTTP_HEADERS
+    cacheable = 'streaming_callback' not in kwargs
+    cached = _RESPONSES_CACHE.get(url) if cacheable else None
+    if cached is not None:
+        etag, last_modified, _ = cached
+        headers = dict(headers)
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if last_modified is not None:
+            headers['If-Modified-Since'] = last_modified
+    http_client = tornado.httpclient.AsyncHTTPClient()
+    attempts = _MAX_ATTEMPTS if cacheable else 1
+    for attempt in range(attempts):
+        async with _REQUESTS_SEMAPHORE:
+            response = await http_client.fetch(url, headers=headers,
+                connect_timeout=_CONNECT_TIMEOUT,
+                request_timeout=_REQUEST_TIMEOUT, raise_error=False, **kwargs)
+        if response.code not in (429, 503) or attempt == attempts - 1:
+            break
+        await tornado.gen.sleep(min(2 ** attempt, _MAX_RETRY_DELAY))
+    if response.code == 304 and cached is not None:
+        # Not modified, use the cached body
+        _RESPONSES_CACHE.move_to_end(url)
+        return cached[2]
+    response.rethrow()
+    if cacheable:
+        etag = response.headers.get('Etag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag is not None or last_modified is not None:
+            _cache_response(url, etag, last_modified, response.body)
+    return response.body
+
+def _cache_response(url, etag, last_modified, body):
+    '''Remember the response to url, dropping the least recently used ones
+    while the bodies exceed _RESPONSES_CACHE_MAX_BYTES.
+    '''
+    global _responses_cache_bytes
+    old = _RESPONSES_CACHE.pop(url, None)
+    if old is not None:
+        _responses_cache_bytes -= len(old[2])
+    if len(body) > _RESPONSES_CACHE_MAX_BYTES:
+        return
+    _RESPONSES_CACHE[url] = (etag, last_modified, body)
+    _responses_cache_bytes += len(body)
+    while _responses_cache_bytes > _RESPONSES_CACHE_MAX_BYTES:
+        _, (_, _, dropped) = _RESPONSES_CACHE.popitem(last=False)
+        _responses_cache_bytes -= len(dropped)
+
+async def _parse(parser, body):
+    '''Feed the body of an IMDB page to parser. The page is decoded and
+    parsed in the default executor, not to block the IOLoop.
+    '''
+    await tornado.ioloop.IOLoop.current().run_in_executor(
+        None, _feed, parser, body)
+
+async def _fetch_and_parse(url, parser):
+    '''Fetch an IMDB url, parse it with parser and return the parser's
+    attrs.
+    '''
+    body = await _fetch(url)
+    await _parse(parser, body)
+    return parser.attrs
+
+def _feed(parser, body):
+    '''Decode body and feed it to parser.'''
+    parser.feed(body.decode('utf-8'))
+
 def _parse_title(data):
-    '''Return the air and end year of a tv series.'''
-    air_year = end_year = type_ = None
+    '''Return the title, type, air year and end year of a title from the
+    content of its og:title element.
+    '''
     m = _RE_TITLE_TYPE_YEAR.search(data)
-    if m:
-        type_ = m.group('type')
-        air_year = m.group('air_year')
-        if air_year is not None:
-            air_year = int(air_year)
-        end_year = m.group('end_year')
-        if end_year is not None:
-            if end_year.strip() != '':
-                end_year = int(end_year)
-            else:
-                end_year = 0
-        title = data[:m.start()].strip()
-    else:
+    if m is None:
         m = _RE_TITLE.match(data)
-        title = m.group('title')
-    return title, type_, air_year, end_year
+        return m.group(1) if m is not None else data, None, None, None
+    type_, air_year, end_year = m.groups()
+    if end_year is not None:
+        end_year = int(end_year) if end_year.strip() else 0
+    return data[:m.start()].strip(), type_, int(air_year), end_year
+
+
+class _StopParsing(Exception):
+    '''Raised by a parser when it doesn't need the rest of the page.'''
 
 
 class SearchParser(html.parser.HTMLParser):
@@ -96,8 +196,12 @@ class SearchParser(html.parser.HTMLParser):
     </table>
     '''
 
-    def __init__(self):
+    def __init__(self, accept=None, limit=None):
         super(SearchParser, self).__init__()
+        # Function that tells if a result must be kept, and maximum number of
+        # results to keep (all if None)
+        self._accept = accept
+        self._limit = limit
         # True if we are in the title column
         self._in_title = False
         # True if we are inside the <a> element that contains the IMDB ID
@@ -111,14 +215,13 @@ class SearchParser(html.parser.HTMLParser):
     def handle_starttag(self, tag, attrs):
         # Identify the column that contains the title information
         if tag == 'td':
-            for a in attrs:
-                if a == ('class', 'result_text'):
-                    self._in_title = True
+            if dict(attrs).get('class') == 'result_text':
+                self._in_title = True
         # Identify the link that contains the imdb_id
         elif tag == 'a' and self._in_title:
-            for a in attrs:
-                if a[0] == 'href':
-                    self._imdb_id = a[1].split('/')[2]
+            href = dict(attrs).get('href')
+            if href is not None:
+                self._imdb_id = href.split('/')[2]
             self._in_ref = True
 
     def handle_data(self, data):
@@ -141,14 +244,19 @@ class SearchParser(html.parser.HTMLParser):
             # If type was none, means it is a Movie
             if self._type is None:
                 self._type = 'Movie'
-            self.results.append(IMDBTitle(self._imdb_id, {
+            result = IMDBTitle(self._imdb_id, {
                 'title': self._title,
                 'year': self._year,
                 'type': self._type,
-            }))
+            })
             # Reset state variables.
             self._in_title = False
             self._year = self._type = None
+            if self._accept is None or self._accept(result):
+                self.results.append(result)
+                if len(self.results) == self._limit:
+                    # Enough results, skip the rest of the page
+                    raise _StopParsing()
         elif tag == 'a':
             self._in_ref = False
 
@@ -190,75 +298,64 @@ class TitleParser(html.parser.HTMLParser):
         self._in_db = False
         # True if we are inside the <div> element that contains the poster
         self._in_poster = False
-        # True if we are inside the <div> element that contains the seasons
-        self._in_seasons = False
         self.attrs = {}
 
     def handle_starttag(self, tag, attrs):
         if tag == 'script':
             # Check if it is the DB elements
-            for a in attrs:
-                if a == ('type', 'application/ld+json'):
-                    self._in_db = True
+            if dict(attrs).get('type') == 'application/ld+json':
+                self._in_db = True
         elif tag == 'meta':
             # Check if we are in the title elements
-            in_title = False
-            if attrs[0] == ('property', 'og:title'):
+            a = dict(attrs)
+            if a.get('property') == 'og:title':
                 # Get the air and end years contained in the title
                 (self.attrs['title'], type_, self.attrs['air_year'],
-                    end_year) = _parse_title(attrs[1][1])
+                    end_year) = _parse_title(a['content'])
                 self.attrs['type'] = type_ if type_ else 'Movie'
                 if end_year is not None:
                     self.attrs['end_year'] = end_year
         elif tag == 'div':
             # Check if we are in the poster <div> element
-            for a in attrs:
-                if a == ('class', 'poster'):
-                    self._in_poster = True
+            if dict(attrs).get('class') == 'poster':
+                self._in_poster = True
         elif tag == 'img' and self._in_poster:
             # When in poster, img contains the link to the poster image
-            for a in attrs:
-                if a[0] == 'src':
-                    self.attrs['poster_url_small'] = a[1]
+            src = dict(attrs).get('src')
+            if src is not None:
+                self.attrs['poster_url_small'] = src
         elif tag == 'a':
-            for a in attrs:
-                if a[0] == 'href':
-                    m = _RE_SEASON.match(a[1])
-                    if m is not None:
-                        if 'seasons' not in self.attrs:
-                            self.attrs['seasons'] = {}
-                        self.attrs['seasons'][m.group('season')] = {}
+            href = dict(attrs).get('href')
+            if href is not None:
+                m = _RE_SEASON.match(href)
+                if m is not None:
+                    seasons = self.attrs.setdefault('seasons', {})
+                    seasons[m.group('season')] = {}
 
     def handle_data(self, data):
         if self._in_db:
-            db = json.loads(data)
-            # The description may be missing
-            try:
-                self.attrs['plot'] = db['description']
-            except KeyError: pass
-            try:
-                self.attrs['poster_url'] = db['image']
-            except KeyError: pass
-            try:
-                self.attrs['genre'] = db['genre']
-            except KeyError: pass
-            try:
-                m = _RE_DURATION.match(db['duration'])
+            db = _json_loads(data)
+            # Any of the attributes may be missing
+            for src, dst in (('description', 'plot'), ('image', 'poster_url'),
+                    ('genre', 'genre')):
+                value = db.get(src)
+                if value is not None:
+                    self.attrs[dst] = value
+            duration = db.get('duration')
+            if duration is not None:
+                m = _RE_DURATION.match(duration)
                 if m is not None:
                     self.attrs['duration'] = '{}h {}m'.format(
                         m.group('h'), m.group('m'))
-            except KeyError: pass
-            # The rating may be missing
-            try:
-                self.attrs['rating'] = db['aggregateRating']['ratingValue']
-            except KeyError: pass
+            rating = db.get('aggregateRating', {}).get('ratingValue')
+            if rating is not None:
+                self.attrs['rating'] = rating
 
     def handle_endtag(self, tag):
         if tag == 'script':
             self._in_db = False
         elif tag == 'div':
             self._in_poster = False
-            self._in_seasons = False
 
 
 class SeasonParser(html.parser.HTMLParser):
@@ -282,6 +379,13 @@ class SeasonParser(html.parser.HTMLParser):
     </div>
     '''
 
+    # Elements whose text is being parsed
+    _NONE, _AIRDATE, _RATING, _PLOT, _TITLE = range(5)
+    # Episode's key where to store the text of each element, and function to
+    # convert it, indexed by element
+    _FIELDS = (None, ('air_date', str.strip), ('rating', float),
+        ('plot', str.strip), ('title', str))
+
     def __init__(self, season):
         super(SeasonParser, self).__init__()
         # Holds the dictionary of episodes for the requested season
@@ -289,94 +393,66 @@ class SeasonParser(html.parser.HTMLParser):
         # Holds a dictionary with all the seasons (only one season is requested
         # at a time, but is for easy integration with the IMDBTitle object).
         self.attrs = {str(season): self.episodes}
-        # True if we are inside the <div> element that contains the airdate
-        self._in_airdate = False
+        # The element that contains the text being parsed (airdate, rating,
+        # plot, title or none of them)
+        self._state = self._NONE
         # True if we are inside the <div> element which is the top level rating
         # containter
         self._in_rating_container = False
-        # True if we are inside the <span> element that contains the rating
-        self._in_rating = False
-        # True if we are inside the <div> element that contains the episode
-        # plot.
-        self._in_plot = False
-        # True if we are inside the <a> element that contains the title
-        self._in_title = False
 
     def handle_starttag(self, tag, attrs):
         if tag == 'img':
             # Check if it is a episode still and get the source of the image
-            is_still = False
-            for a in attrs:
-                if a == ('class', 'zero-z-index'):
-                    is_still = True
-                elif a[0] == 'src':
-                    still = a[1]
-            if is_still:
-                self.current_episode['still'] = still
+            a = dict(attrs)
+            if a.get('class') == 'zero-z-index':
+                self.current_episode['still'] = a['src']
         elif tag == 'meta':
             # Check if it is the episode number
-            is_episodenumber = False
-            for a in attrs:
-                if a == ('itemprop', 'episodeNumber'):
-                    is_episodenumber = True
-                elif a[0] == 'content':
-                    episodenumber = a[1]
-            if is_episodenumber:
-                self.episodes[episodenumber] = self.current_episode
+            a = dict(attrs)
+            if a.get('itemprop') == 'episodeNumber':
+                self.episodes[a['content']] = self.current_episode
         elif tag == 'div':
-            for a in attrs:
-                if a == ('class', 'list_item odd') or a == (
-                        'class', 'list_item even'):
-                    # New episode
-                    self.current_episode = {}
-                    break
-                elif a == ('class', 'airdate'):
-                    self._in_airdate = True
-                    break
-                elif a == ('class', 'ipl-rating-star '):
-                    self._in_rating_container = True
-                    break
-                elif a == ('class', 'item_description'):
-                    self._in_plot = True
-                    break
+            c = dict(attrs).get('class')
+            if c in {'list_item odd', 'list_item even'}:
+                # New episode
+                self.current_episode = {}
+            elif c == 'airdate':
+                self._state = self._AIRDATE
+            elif c == 'ipl-rating-star ':
+                self._in_rating_container = True
+            elif c == 'item_description':
+                self._state = self._PLOT
         elif tag == 'span' and self._in_rating_container:
-            for a in attrs:
-                if a == ('class', 'ipl-rating-star__rating'):
-                    self._in_rating = True
-                    break
+            if dict(attrs).get('class') == 'ipl-rating-star__rating':
+                self._state = self._RATING
         elif tag == 'a':
-            for a in attrs:
-                if a == ('itemprop', 'name'):
-                    self._in_title = True
-                    break
+            if dict(attrs).get('itemprop') == 'name':
+                self._state = self._TITLE
 
     def handle_data(self, data):
-        if self._in_airdate:
-            self.current_episode['air_date'] = data.strip()
-        elif self._in_rating:
-            self.current_episode['rating'] = float(data)
-        elif self._in_plot:
-            self.current_episode['plot'] = data.strip()
-        elif self._in_title:
-            self.current_episode['title'] = data
+        field = self._FIELDS[self._state]
+        if field is not None:
+            key, convert = field
+            self.current_episode[key] = convert(data)
 
     def handle_endtag(self, tag):
+        state = self._state
         if tag == 'div':
-            if self._in_airdate:
-                self._in_airdate = False
-            elif self._in_rating_container:
+            if state == self._AIRDATE or state == self._PLOT:
+                self._state = self._NONE
+            else:
                 self._in_rating_container = False
-            elif self._in_plot:
-                self._in_plot = False
-        elif tag == 'span' and self._in_rating:
-            self._in_rating = False
-        elif tag == 'a' and self._in_title:
-            self._in_title = False
+        elif tag == 'span' and state == self._RATING:
+            self._state = self._NONE
+        elif tag == 'a' and state == self._TITLE:
+            self._state = self._NONE
 
 
 class IMDBTitle(object):
     '''Represents a title in the IMDB database.'''
 
+    __slots__ = ('id', '_attrs')
+
     def __init__(self, imdb_id, attrs=None):
         self.id = imdb_id
         if attrs is None:
@@ -403,18 +479,11 @@ class IMDBTitle(object):
         '''Obtain the remaining attributes from the title's main IMDB page.'''
         # Fetch the title page
         url = _IMDB_TITLE_URL.format(self.id)
-        http_client = tornado.httpclient.AsyncHTTPClient()
-        response = await http_client.fetch(url, headers=_HTTP_HEADERS)
         # Parse the important information
-        parser = TitleParser()
-        parser.feed(response.body.decode('utf-8'))
-        self._attrs.update(parser.attrs)
+        self._attrs.update(await _fetch_and_parse(url, TitleParser()))
         # Build a list with the seasons generators
-        try:
-            seasons = self._attrs['seasons']
-            generators = [self._fetch_season(s, dest) for s in seasons.keys()]
-        except KeyError:
-            generators = []
+        generators = [self._fetch_season(s, dest)
+            for s in self._attrs.get('seasons', ())]
         # Add the poster generator
         if dest is not None:
             generators.append(self._fetch_posters(dest))
@@ -425,12 +494,9 @@ class IMDBTitle(object):
         '''Obtain a given season's episodes descriptions.'''
         # Fetch the title page
         url = _IMDB_SEASON_URL.format(self.id, season)
-        http_client = tornado.httpclient.AsyncHTTPClient()
-        response = await http_client.fetch(url, headers=_HTTP_HEADERS)
         # Parse the important information
-        parser = SeasonParser(season)
-        parser.feed(response.body.decode('utf-8'))
-        self._attrs['seasons'].update(parser.attrs)
+        self._attrs['seasons'].update(
+            await _fetch_and_parse(url, SeasonParser(season)))
         # Fetch the episodes stills
         if dest is not None:
             await self._fetch_stills(season, dest)
@@ -468,13 +534,11 @@ class IMDBTitle(object):
         '''Fetch a picture from the url and store it in dest.'''
         path = os.path.join(dest, url.rpartition('/')[-1])
         if not os.path.exists(path):
-            http_client = tornado.httpclient.AsyncHTTPClient()
             try:
                 with open(path, 'wb') as f:
                     def on_chunk(chunk):
                         f.write(chunk)
-                    await http_client.fetch(url, headers=_HTTP_HEADERS,
-                        streaming_callback=on_chunk)
+                    await _fetch(url, streaming_callback=on_chunk)
             except tornado.curl_httpclient.CurlError as e:
                 logging.info('failed to fetch image for {}'.format(
                     self._attrs['title']))
@@ -486,10 +550,12 @@ class IMDBTitle(object):
                 raise
 
 
-async def search(title, title_types, year=None):
+async def search(title, title_types, year=None, limit=None):
     '''Search by title in the IMDB site.
     title_type might be one of: 'Movie', 'TV Series', 'Video', 'Short',
     'TV Mini-Series', 'TV Movie', 'TV Episode' or 'Video Game'.
+    If limit is given, return at most limit results (the page is parsed only
+    until they are found).
     '''
     # Check that the type of title is correct
     for t in title_types:
@@ -501,17 +567,20 @@ async def search(title, title_types, year=None):
         _IMDB_SEARCH_URL, urllib.parse.urlencode(search_attributes))
 
     # Fetch the list of titles
-    http_client = tornado.httpclient.AsyncHTTPClient()
-    response = await http_client.fetch(url, headers=_HTTP_HEADERS)
+    body = await _fetch(url)
 
     # Parse the desired information from the result
-    parser = SearchParser()
-    parser.feed(response.body.decode('utf-8'))
-
-    # Return the list of titles
     # Keep only the titles with the right type or, if the year is given, those
     # corresponding to that year.
-    return [a for a in parser.results
-        if a['type'] in title_types
-        and (year is None or a['year'] == year or a['year'] == year - 1)]
+    def accept(a):
+        return a['type'] in title_types and (
+            year is None or a['year'] == year or a['year'] == year - 1)
+    parser = SearchParser(accept, limit)
+    try:
+        await _parse(parser, body)
+    except _StopParsing:
+        pass
+
+    # Return the list of titles
+    return parser.results
 
@@ -20,6 +20,9 @@ along with tvfamily; see the file COPYING.  If not, see
 <http://www.gnu.org/licenses/>.
 '''
 
+import functools
+import types
+
 import tvfamily.PTN
 
 __author__ = 'Antonio Serrano Hernandez'
@@ -32,16 +35,26 @@ __status__ = 'Development'
 __homepage__ = 'https://github.com/aserranoh/tvfamily'
 
 
+@functools.lru_cache(maxsize=4096)
+def parse_name(name):
+    '''Return the information parsed from a torrent or video file name.
+    The results are cached and shared, so they are returned read-only.
+    '''
+    return types.MappingProxyType(tvfamily.PTN.parse(name))
+
+
 class Torrent(object):
     '''Represents a torrent object.'''
 
+    __slots__ = ('name', 'magnet', 'size', 'seeders', 'leechers', 'name_info')
+
     def __init__(self, name, magnet=None, size=0, seeders=0, leechers=0):
         self.name = name
         self.magnet = magnet
         self.size = size
         self.seeders = seeders
         self.leechers = leechers
-        self.name_info = tvfamily.PTN.parse(self.name)
+        self.name_info = parse_name(self.name)
 
     def todict(self):
         '''Return a dictionary with the elements of this instance.'''
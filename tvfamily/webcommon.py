@@ -23,6 +23,13 @@ along with tvfamily; see the file COPYING.  If not, see
 import json
 import tornado.web
 
+# Use orjson to encode the responses if it's available
+try:
+    import orjson
+    _json_dumps = orjson.dumps
+except ImportError:
+    _json_dumps = json.dumps
+
 __script__ = 'tvfamily'
 __author__ = 'Antonio Serrano Hernandez'
 __copyright__ = 'Copyright (C) 2018 Antonio Serrano Hernandez'
@@ -45,12 +52,43 @@ class BaseHandler(tornado.web.RequestHandler):
         '''
         self._core = core
 
+    def compute_etag(self):
+        '''Don't hash the responses to compute their ETag. Most of them are
+        dynamic JSON documents; the handlers that can be revalidated
+        compute their own.
+        '''
+        return None
+
+    def get_uploaded_file(self, name='file'):
+        '''Return the first file uploaded in the form field name, as a
+        tornado.httputil.HTTPFile. Raise KeyError if there's none.
+        '''
+        files = self.request.files.get(name)
+        if not files:
+            raise KeyError(name)
+        return files[0]
+
+    def get_season_episode(self):
+        '''Return the season and episode numbers given in the query
+        arguments. Without season, the episode is ignored and (None, None)
+        is returned; without episode, it is returned as None.
+        '''
+        season = self.get_query_argument('season', None)
+        if season is None:
+            return None, None
+        episode = self.get_query_argument('episode', None)
+        return int(season), None if episode is None else int(episode)
+
     def write_json(self, **kwargs):
         '''Send json data.'''
-        self.set_header('Content-Type', 'application/json')
         if 'code' not in kwargs:
             kwargs['code'] = 0
-        self.write(json.dumps(kwargs))
+        self.write_json_blob(_json_dumps(kwargs))
+
+    def write_json_blob(self, blob):
+        '''Send json data already encoded.'''
+        self.set_header('Content-Type', 'application/json')
+        self.write(blob)
 
     def write_error(self, code=1, msg=''):
         '''Write an error code and an error message.'''
@@ -20,6 +20,8 @@ along with tvfamily; see the file COPYING.  If not, see
 <http://www.gnu.org/licenses/>.
 '''
 
+import os
+import tornado.escape
 import tornado.ioloop
 import tornado.iostream
 import tornado.web
@@ -70,16 +72,32 @@ class PlayHandler(tvfamily.webcommon.BaseHandler):
         title = await self._core.get_title(category, imdb_id)
         video = self._core.get_video_from_file(video_file)
         self.render('playmovie.html', category=category, title=title,
-            video=video)
+            video=video, subtitles_url=self._subtitles_url)
 
+    def _subtitles_url(self, path):
+        '''Return the URL of the subtitles file in path. The path is given
+        relative to the videos directory, the root of the subtitles route.
+        '''
+        path = os.path.relpath(path, self._core.get_videos_path())
+        return '/subtitles/{}'.format(
+            tornado.escape.url_escape(path, plus=False))
 
-class SubtitlesHandler(tvfamily.webcommon.BaseHandler):
-    '''Serves a vtt subtitles file.'''
 
-    def get(self, filename):
-        '''Send the subtitle filename to the client.'''
-        with open(filename, 'r') as f:
-            self.write(f.read())
+class SubtitlesHandler(tornado.web.StaticFileHandler):
+    '''Serves a vtt subtitles file from the videos directory.'''
+
+    def get_content_type(self):
+        return 'text/vtt; charset=UTF-8'
+
+
+class IconsHandler(tornado.web.StaticFileHandler):
+    '''Serves the application icons, that the browser may keep for a while
+    without revalidating them.'''
+
+    CACHE_TIME = 7 * 24 * 3600
+
+    def get_cache_time(self, path, modified, mime_type):
+        return self.CACHE_TIME
 
 
 class SettingsHandler(tvfamily.webcommon.BaseHandler):
@@ -124,15 +142,14 @@ class WebServer(tvfamily.httpserver.HTTPServer):
             self._core = tvfamily.core.Core(self.options, self.daemonize)
             d = {'core': self._core}
             handlers = [
-                (r'/', tornado.web.RedirectHandler, {'url': '/index.html'}),
-                (r'/(index.html)', tornado.web.StaticFileHandler,
+                (r'/', tornado.web.RedirectHandler,
+                    {'url': '/index.html', 'permanent': True}),
+                (r'/(index\.html|styles\.css)', tornado.web.StaticFileHandler,
                     {'path': 'web'}),
                 (r'/play', PlayHandler, d),
-                (r'(.*?\.vtt)', SubtitlesHandler),
-                (r'/(styles.css)', tornado.web.StaticFileHandler,
-                    {'path': 'web'}),
-                (r'/(.*?\.svg)', tornado.web.StaticFileHandler,
-                    {'path': 'data'}),
+                (r'/subtitles/([A-Za-z0-9_.%/-]+\.vtt)', SubtitlesHandler,
+                    {'path': self._core.get_videos_path()}),
+                (r'/([\w-]+\.svg)', IconsHandler, {'path': 'data'}),
                 (r'/settings', SettingsHandler, d),
                 (r'/save-settings', SaveSettingsHandler, d),
                 ]
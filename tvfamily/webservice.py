@@ -21,6 +21,10 @@ along with tvfamily; see the file COPYING.  If not, see
 '''
 
 import json
+import re
+import tornado.gen
+import tornado.ioloop
+import tornado.iostream
 import tornado.web
 
 import tvfamily.core
@@ -35,17 +39,50 @@ __email__ = 'toni.serranoh@gmail.com'
 __status__ = 'Development'
 __homepage__ = 'https://github.com/aserranoh/tvfamily'
 
+# Single range in a Range header (bytes=start-end)
+_RE_RANGE = re.compile(r'\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$')
+
+def _parse_range(range_header):
+    '''Parse the value of a Range header. Return the tuple (start, end) of the
+    range, with end exclusive, or None if the header is not valid.
+    '''
+    m = _RE_RANGE.match(range_header)
+    if m is None:
+        # Not a single range (multiple ranges are not supported)
+        return None
+    start, end = m.groups()
+    if start:
+        start = int(start)
+        if end:
+            end = int(end)
+            if start > end:
+                return None
+            end += 1
+        else:
+            end = None
+    elif end:
+        # Suffix range, the last bytes of the file (a suffix of length 0 is
+        # kept as end 0, that is not satisfiable)
+        end = int(end)
+        start, end = (-end, None) if end else (None, 0)
+    else:
+        return None
+    return start, end
+
 # Profiles handlers
 
 class GetProfilesHandler(tvfamily.webcommon.BaseHandler):
     '''Return the profiles list.'''
 
     def get(self):
-        self.write_json(profiles=[p.name for p in self._core.get_profiles()])
+        self.write_json_blob(self._core.get_profiles_blob())
 
 class GetProfilePictureHandler(tvfamily.webcommon.BaseHandler):
     '''Return the picture for the given profile.'''
 
+    # The pictures are small and kept in memory, use the hash of the body
+    compute_etag = tornado.web.RequestHandler.compute_etag
+
     def get(self):
         try:
             name = self.get_query_argument('name')
@@ -64,11 +101,11 @@ class GetProfilePictureHandler(tvfamily.webcommon.BaseHandler):
 class SetProfilePictureHandler(tvfamily.webcommon.BaseHandler):
     '''Set the picture for the given profile.'''
 
-    def get(self):
+    async def get(self):
         try:
             name = self.get_query_argument('name')
             try:
-                self._core.set_profile_picture(name)
+                await self._core.set_profile_picture(name)
                 self.write_json(code=0)
             except (KeyError) as e:
                 self.write_error(msg=str(e))
@@ -77,12 +114,12 @@ class SetProfilePictureHandler(tvfamily.webcommon.BaseHandler):
         except KeyError:
             self.write_error(msg='malformed request')
 
-    def post(self):
+    async def post(self):
         try:
             name = self.get_query_argument('name')
-            pic = self.request.files['file'][0]['body']
+            pic = self.get_uploaded_file().body
             try:
-                self._core.set_profile_picture(name, pic)
+                await self._core.set_profile_picture(name, pic)
                 self.write_json(code=0)
             except (KeyError, IOError) as e:
                 self.write_error(msg=str(e))
@@ -94,22 +131,22 @@ class SetProfilePictureHandler(tvfamily.webcommon.BaseHandler):
 class CreateProfileHandler(tvfamily.webcommon.BaseHandler):
     '''Create a new profile.'''
 
-    def get(self):
+    async def get(self):
         try:
             name = self.get_query_argument('name')
-            self._core.create_profile(name)
+            await self._core.create_profile(name)
             self.write_json(code=0)
         except tornado.web.MissingArgumentError:
             self.write_error(msg="missing 'name' argument")
         except ValueError as e:
             self.write_error(msg=str(e))
 
-    def post(self):
+    async def post(self):
         try:
             name = self.get_query_argument('name')
-            pic = self.request.files['file'][0]['body']
+            pic = self.get_uploaded_file().body
             try:
-                self._core.create_profile(name, pic)
+                await self._core.create_profile(name, pic)
                 self.write_json(code=0)
             except IOError as e:
                 self.write_error(msg=str(e))
@@ -137,16 +174,16 @@ class GetCategoriesHandler(tvfamily.webcommon.BaseHandler):
     '''Return the categories list.'''
 
     def get(self):
-        self.write_json(categories=self._core.get_categories())
+        self.write_json_blob(self._core.get_categories_blob())
 
 class GetTopHandler(tvfamily.webcommon.BaseHandler):
     '''Return the top list of medias of a given category.'''
 
-    def get(self):
+    async def get(self):
         try:
             category = self.get_query_argument('category')
             profile = self.get_query_argument('profile')
-            medias = self._core.top(profile, category)
+            medias = await self._core.top(profile, category)
             self.write_json(top=[m.todict() for m in medias])
         except (tornado.web.MissingArgumentError,
                 tvfamily.core.CoreError, KeyError) as e:
@@ -155,14 +192,29 @@ class GetTopHandler(tvfamily.webcommon.BaseHandler):
 class GetPosterHandler(tvfamily.webcommon.BaseHandler):
     '''Return the poster of a given title.'''
 
+    # Time that the clients may keep a poster without revalidating it
+    _CACHE_TIME = 24 * 3600
+
+    _etag = None
+
+    def compute_etag(self):
+        return self._etag
+
     def get(self):
         try:
             title_id = self.get_query_argument('id')
             self.set_header('Content-Type', 'image/jpg')
-            pic = self._core.get_poster(title_id)
-            if pic is not None:
-                self.write(pic.read())
-                pic.close()
+            poster = self._core.get_poster(title_id)
+            if poster is not None:
+                data, mtime = poster
+                self._etag = '"{:x}-{:x}"'.format(mtime, len(data))
+                self.set_etag_header()
+                self.set_header(
+                    'Cache-Control', 'max-age={}'.format(self._CACHE_TIME))
+                if self.check_etag_header():
+                    self.set_status(304)
+                    return
+                self.write(data)
             else:
                 t = self._core.get_title(title_id)
                 self.redirect(t.get_poster_url())
@@ -178,8 +230,9 @@ class SearchHandler(tvfamily.webcommon.BaseHandler):
         try:
             category = self.get_query_argument('category')
             text = self.get_query_argument('text')
-            titles = await self._core.search(category, text)
-            self.write_json(search=[t.todict() for t in titles])
+            titles, truncated = await self._core.search(category, text)
+            self.write_json(search=[t.todict() for t in titles],
+                truncated=truncated)
         except Exception as e:
             self.write_error(msg=str(e))
 
@@ -199,12 +252,7 @@ class GetMediaStatusHandler(tvfamily.webcommon.BaseHandler):
     def get(self):
         try:
             title_id = self.get_query_argument('id')
-            season = episode = None
-            try:
-                season = int(self.get_query_argument('season'))
-                episode = int(self.get_query_argument('episode'))
-            except tornado.web.MissingArgumentError:
-                pass
+            season, episode = self.get_season_episode()
             status = self._core.get_media_status(
                 title_id, season, episode)
             self.write_json(status=status.todict())
@@ -217,12 +265,7 @@ class DownloadHandler(tvfamily.webcommon.BaseHandler):
         try:
             profile = self.get_query_argument('profile')
             title_id = self.get_query_argument('id')
-            season = episode = None
-            try:
-                season = int(self.get_query_argument('season'))
-                episode = int(self.get_query_argument('episode'))
-            except tornado.web.MissingArgumentError:
-                pass
+            season, episode = self.get_season_episode()
             self._core.download(profile, title_id, season, episode)
             self.write_json(code=0)
         except (tornado.web.MissingArgumentError, KeyError) as e:
@@ -231,8 +274,8 @@ class DownloadHandler(tvfamily.webcommon.BaseHandler):
 class GetVideoHandler(tvfamily.webcommon.BaseHandler):
     '''Serves a video in chunks.'''
 
-    def compute_etag(self):
-        return None
+    # Bytes written before waiting for them to be sent, when sending by chunks
+    _FLUSH_WATERMARK = 4 * 1024 * 1024
 
     @classmethod
     def get_content_version(cls, abspath):
@@ -246,77 +289,119 @@ class GetVideoHandler(tvfamily.webcommon.BaseHandler):
         # Obtain the video to play
         try:
             title_id = self.get_query_argument('id')
-            season = episode = None
-            try:
-                season = int(self.get_query_argument('season'))
-                episode = int(self.get_query_argument('episode'))
-            except tornado.web.MissingArgumentError:
-                pass
+            season, episode = self.get_season_episode()
             video = self._core.get_video(title_id, season, episode)
         except (tornado.web.MissingArgumentError, KeyError) as e:
             self.write_error(msg=str(e))
             return
+        # Open the video first, its size is obtained from the opened file
+        with video.open() as f:
+            await self._serve(video, f)
+
+    async def _serve(self, video, f):
+        '''Serve the range requested of the opened video file f.'''
         request_range = None
         range_header = self.request.headers.get('Range')
         size = video.get_size()
+        # The video's version, to let the client revalidate its cache
+        etag = '"{:x}-{:x}"'.format(video.get_mtime_ns(), size)
+        self.set_header('Etag', etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        # Ignore the range if it refers to another version of the video
+        if_range = self.request.headers.get('If-Range')
+        if if_range is not None and if_range != etag:
+            range_header = None
         # Obtain the start, end and total size of the range to serve
         if range_header:
             # As per RFC 2616 14.16, if an invalid Range header is specified,
             # the request will be treated as if the header didn't exist.
-            request_range = tornado.httputil._parse_request_range(range_header)
+            request_range = _parse_range(range_header)
         if request_range:
             start, end = request_range
-            if (start is not None and start >= size) or end == 0:
+            # Resolve suffix ranges and cap the end at the file size (clients
+            # sometimes blindly use a large range to limit their download
+            # size). A start of None only comes with a suffix of length 0
+            if start is None:
+                start = 0
+            elif start < 0:
+                start = max(start + size, 0)
+            end = size if end is None else min(end, size)
+            if start >= end:
                 # As per RFC 2616 14.35.1, a range is not satisfiable only: if
                 # the first requested byte is equal to or greater than the
                 # content, or when a suffix with length 0 is specified
                 self.set_status(416)  # Range Not Satisfiable
-                self.set_header("Content-Type", "text/plain")
-                self.set_header("Content-Range", "bytes */%s" % (size, ))
+                self.set_header('Content-Type', 'text/plain')
+                self.set_header('Content-Range', 'bytes */{}'.format(size))
                 return
-            if start is not None and start < 0:
-                start += size
-            if end is not None and end > size:
-                # Clients sometimes blindly use a large range to limit their
-                # download size; cap the endpoint at the actual file size.
-                end = size
             self.set_status(206)
             self.set_header('Content-Range',
-                tornado.httputil._get_content_range(start, end, size))
+                'bytes {}-{}/{}'.format(start, end - 1, size))
         else:
-            start = end = None
+            start, end = 0, size
         self.set_header('Content-Type', 'video/mp4')
         self.set_header('Accept-Ranges', 'bytes')
-        self.set_header('Content-Length', str(size))
-        # Serve the content
-        content = video.get_content(start, end)
-        for chunk in content:
-            self.write(chunk)
-            try:
-                await self.flush()
-            except tornado.iostream.StreamClosedError: pass
+        self.set_header('Content-Length', str(end - start))
+        # Serve the content. Don't let Nagle's algorithm hold back the tail
+        # of each write
+        self.set_nodelay(True)
+        try:
+            await self._send_chunks(video, f, start, end)
+        except tornado.iostream.StreamClosedError: pass
+
+    async def _send_chunks(self, video, f, start, end):
+        '''Send the video from start to end by chunks.
+
+        The chunks are read in a thread pool, so the IOLoop is not blocked by
+        the disk. They are flushed only when enough data is pending, and
+        the next chunk is read while the pending ones are sent.
+        '''
+        io_loop = tornado.ioloop.IOLoop.current()
+        content = video.get_content(f, start, end)
+        try:
+            chunk = await io_loop.run_in_executor(None, next, content, None)
+            pending = 0
+            while chunk is not None:
+                self.write(chunk)
+                pending += len(chunk)
+                if pending >= self._FLUSH_WATERMARK:
+                    chunk, _ = await tornado.gen.multi([
+                        io_loop.run_in_executor(None, next, content, None),
+                        self.flush()])
+                    pending = 0
+                else:
+                    chunk = await io_loop.run_in_executor(
+                        None, next, content, None)
+        finally:
+            content.close()
+
+# Routes of the web service API
+_ROUTES = (
+    (r'/api/getprofiles', GetProfilesHandler),
+    (r'/api/getprofilepicture', GetProfilePictureHandler),
+    (r'/api/setprofilepicture', SetProfilePictureHandler),
+    (r'/api/createprofile', CreateProfileHandler),
+    (r'/api/deleteprofile', DeleteProfileHandler),
+    (r'/api/getcategories', GetCategoriesHandler),
+    (r'/api/gettop', GetTopHandler),
+    (r'/api/getposter', GetPosterHandler),
+    (r'/api/search', SearchHandler),
+    (r'/api/gettitle', GetTitleHandler),
+    (r'/api/getmediastatus', GetMediaStatusHandler),
+    (r'/api/download', DownloadHandler),
+    (r'/api/getvideo', GetVideoHandler),
+)
 
 class WebService(object):
     '''Represents the web service API.'''
 
     def __init__(self, core):
         self._core = core
+        d = {'core': core}
+        self._handlers = tuple((p, h, d) for p, h in _ROUTES)
 
     def get_handlers(self):
-        d = {'core': self._core}
-        return [
-            (r'/api/getprofiles', GetProfilesHandler, d),
-            (r'/api/getprofilepicture', GetProfilePictureHandler, d),
-            (r'/api/setprofilepicture', SetProfilePictureHandler, d),
-            (r'/api/createprofile', CreateProfileHandler, d),
-            (r'/api/deleteprofile', DeleteProfileHandler, d),
-            (r'/api/getcategories', GetCategoriesHandler, d),
-            (r'/api/gettop', GetTopHandler, d),
-            (r'/api/getposter', GetPosterHandler, d),
-            (r'/api/search', SearchHandler, d),
-            (r'/api/gettitle', GetTitleHandler, d),
-            (r'/api/getmediastatus', GetMediaStatusHandler, d),
-            (r'/api/download', DownloadHandler, d),
-            (r'/api/getvideo', GetVideoHandler, d),
-        ]
-
+        '''Return the handlers of the web service API.'''
+        return self._handlers